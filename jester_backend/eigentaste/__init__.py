@@ -3,4 +3,5 @@ __author__ = 'Viraj Mahesh'
 from eigentaste import Eigentaste, StoredEigentasteModel, JOKE_CLUSTERS
 from cluster import Cluster
 from point import Point
+from model_cache import get_stored_model
 
@@ -1,3 +1,4 @@
+import numpy as np
 from point import Point
 
 
@@ -77,4 +78,54 @@ class Cluster(object):
     def import_model(self, model):
         top_left = Point.import_model(model['top left'])
         bottom_right = Point.import_model(model['bottom right'])
-        return Cluster(top_left, bottom_right)
\ No newline at end of file
+        return Cluster(top_left, bottom_right)
+
+    def bounds(self):
+        """
+        :return: The bounds of the cluster as (left, top, right, bottom).
+        """
+        return (self.top_left.x, self.top_left.y,
+                self.bottom_right.x, self.bottom_right.y)
+
+    @classmethod
+    def import_bounds(cls, bounds):
+        left, top, right, bottom = bounds
+        return Cluster(Point(left, top), Point(right, bottom))
+
+
+def cluster_bounds(clusters):
+    """
+    :param clusters: A list of clusters.
+    :return: A N x 4 array with the bounds of each cluster as rows of
+        (left, top, right, bottom).
+    """
+    return np.array([cluster.bounds() for cluster in clusters],
+                    dtype=np.float64).reshape(-1, 4)
+
+
+def assign_clusters(points, bounds, chunk_size=65536):
+    """
+    Assigns a batch of points to clusters. Each point is assigned to the
+    first cluster that contains it, which is the same rule as testing the
+    point against each cluster in turn with Cluster.__contains__.
+
+    :param points: A N x 2 array of points.
+    :param bounds: The bounds of the clusters, as returned by cluster_bounds.
+    :param chunk_size: The number of points that are processed at a time,
+        which bounds the size of the intermediate N x clusters arrays.
+    :return: An array with the cluster index of each point, or -1 if the point
+        is not contained in any cluster.
+    """
+    points = np.asarray(points)
+    left, top, right, bottom = bounds.T
+    indices = np.empty(len(points), dtype=np.intp)
+    for start in range(0, len(points), chunk_size):
+        x = points[start:start + chunk_size, 0, np.newaxis]
+        y = points[start:start + chunk_size, 1, np.newaxis]
+        contained = ((left <= x) & (x <= right) &
+                     (bottom <= y) & (y <= top))
+        # argmax returns the index of the first cluster containing the point
+        chunk = np.argmax(contained, axis=1)
+        chunk[~contained.any(axis=1)] = -1
+        indices[start:start + chunk_size] = chunk
+    return indices
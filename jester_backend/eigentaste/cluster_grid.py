@@ -0,0 +1,173 @@
+from __future__ import division
+import numpy as np
+from cluster import cluster_bounds
+
+
+__author__ = 'Viraj Mahesh'
+
+
+# Maximum number of grid cells along each axis
+MAX_GRID_RESOLUTION = 256
+
+# Relative tolerance used when deciding whether a cluster is a candidate for a
+# grid cell. Keeping extra candidates is harmless, missing one is not.
+TOLERANCE = 10**-9
+
+
+def cluster_centers(bounds):
+    """
+    :param bounds: The bounds of the clusters, as returned by cluster_bounds.
+    :return: A N x 2 array containing the midpoint of each cluster, computed
+        in the same way as Cluster.distance.
+    """
+    left, top, right, bottom = bounds.T
+    return np.column_stack(((left + right) / 2, (top + bottom) / 2))
+
+
+def nearest_clusters(points, centers):
+    """
+    Assigns each point to the cluster with the nearest midpoint. Ties are
+    broken in favour of the cluster with the lowest index.
+
+    :param points: A N x 2 array of points.
+    :param centers: The midpoints of the clusters, see cluster_centers.
+    :return: An array with the cluster index of each point.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    distances = np.sqrt((centers[:, 0] - points[:, 0, np.newaxis]) ** 2 +
+                        (centers[:, 1] - points[:, 1, np.newaxis]) ** 2)
+    return np.argmin(distances, axis=1)
+
+
+class ClusterGrid(object):
+    """
+    A lookup structure that maps a point in the PCA plane to the cluster with
+    the nearest midpoint, which is the rule used to classify new users.
+
+    The bounding box of the clusters is divided into a uniform grid. For each
+    cell we precompute the (usually single) cluster whose midpoint can be the
+    nearest one for some point of the cell. Classifying a point then only
+    requires finding its cell and comparing the distances to the few
+    candidates of that cell. Points outside the grid fall back to comparing
+    the distances to all clusters.
+    """
+    def __init__(self, centers, bounds, shape, offsets, candidates):
+        """
+        :param centers: The midpoints of the clusters.
+        :param bounds: The bounds of the grid as (left, top, right, bottom).
+        :param shape: The number of cells along the x and y axes.
+        :param offsets: Array such that candidates[offsets[i]:offsets[i + 1]]
+            are the candidate clusters of the i-th cell.
+        :param candidates: The candidate cluster indices of all cells.
+        """
+        self.centers = centers
+        self.left, self.top, self.right, self.bottom = bounds
+        self.nx, self.ny = shape
+        self.offsets = offsets
+        self.candidates = candidates
+        self.cell_width = (self.right - self.left) / self.nx
+        self.cell_height = (self.top - self.bottom) / self.ny
+
+    @classmethod
+    def build(cls, clusters, resolution=None):
+        """
+        Builds a grid for a list of clusters.
+
+        :param clusters: The list of clusters.
+        :param resolution: The number of cells along each axis. Defaults to
+            the number of smallest clusters that fit across the bounding box,
+            which for clusters created by recursive bisection aligns the cells
+            with the cluster edges.
+        """
+        bounds = cluster_bounds(clusters)
+        centers = cluster_centers(bounds)
+        left, top = bounds[:, 0].min(), bounds[:, 1].max()
+        right, bottom = bounds[:, 2].max(), bounds[:, 3].min()
+        if resolution is None:
+            widths = bounds[:, 2] - bounds[:, 0]
+            heights = bounds[:, 1] - bounds[:, 3]
+            resolution = max(np.max((right - left) / widths[widths > 0]),
+                             np.max((top - bottom) / heights[heights > 0]))
+            resolution = int(min(np.ceil(resolution), MAX_GRID_RESOLUTION))
+        nx = ny = max(resolution, 1)
+
+        # Bounds of every cell, with cells numbered row by row along x
+        xs = np.linspace(left, right, nx + 1)
+        ys = np.linspace(bottom, top, ny + 1)
+        x0, y0 = [edges.ravel() for edges in np.meshgrid(xs[:-1], ys[:-1])]
+        x1, y1 = [edges.ravel() for edges in np.meshgrid(xs[1:], ys[1:])]
+
+        cx, cy = centers[:, 0], centers[:, 1]
+        # Smallest and largest squared distance from each midpoint to each cell
+        dx_min = np.maximum(np.maximum(x0[:, None] - cx, cx - x1[:, None]), 0)
+        dy_min = np.maximum(np.maximum(y0[:, None] - cy, cy - y1[:, None]), 0)
+        dx_max = np.maximum(np.abs(cx - x0[:, None]), np.abs(cx - x1[:, None]))
+        dy_max = np.maximum(np.abs(cy - y0[:, None]), np.abs(cy - y1[:, None]))
+        min_distance = dx_min ** 2 + dy_min ** 2
+        max_distance = dx_max ** 2 + dy_max ** 2
+        # A cluster can only be the nearest one for some point of the cell if
+        # it is not further away than the furthest point of the best cluster
+        bound = np.min(max_distance, axis=1)[:, None]
+        is_candidate = min_distance <= bound * (1 + TOLERANCE) + TOLERANCE
+
+        offsets = np.concatenate(([0], np.cumsum(is_candidate.sum(axis=1))))
+        candidates = np.nonzero(is_candidate)[1]
+        return cls(centers, (left, top, right, bottom), (nx, ny),
+                   offsets.astype(np.int32), candidates.astype(np.int32))
+
+    def cell(self, x, y):
+        """
+        :return: The index of the cell containing the point (x, y), or None if
+            the point is outside the grid.
+        """
+        if not (self.left <= x <= self.right and
+                self.bottom <= y <= self.top):
+            return None
+        i = min(int((x - self.left) / self.cell_width), self.nx - 1)
+        j = min(int((y - self.bottom) / self.cell_height), self.ny - 1)
+        return j * self.nx + i
+
+    def classify(self, point):
+        """
+        :param point: The coordinates of a point in the PCA plane.
+        :return: The index of the cluster with the nearest midpoint.
+        """
+        x, y = point
+        cell = self.cell(x, y)
+        if cell is None:
+            return int(nearest_clusters([(x, y)], self.centers)[0])
+        candidates = self.candidates[self.offsets[cell]:self.offsets[cell + 1]]
+        if len(candidates) == 1:
+            return int(candidates[0])
+        nearest = nearest_clusters([(x, y)], self.centers[candidates])[0]
+        return int(candidates[nearest])
+
+    def export_model(self):
+        exported_grid = {'bounds': [float(self.left), float(self.top),
+                                    float(self.right), float(self.bottom)],
+                         'shape': [self.nx, self.ny],
+                         'offsets': self.offsets.tolist(),
+                         'candidates': self.candidates.tolist()}
+        return exported_grid
+
+    @classmethod
+    def import_model(cls, model, clusters):
+        centers = cluster_centers(cluster_bounds(clusters))
+        return cls(centers, model['bounds'], model['shape'],
+                   np.array(model['offsets'], dtype=np.int32),
+                   np.array(model['candidates'], dtype=np.int32))
+
+    def export_arrays(self):
+        exported_arrays = {'grid_bounds': np.array([self.left, self.top,
+                                                    self.right, self.bottom]),
+                           'grid_shape': np.array([self.nx, self.ny]),
+                           'grid_offsets': self.offsets,
+                           'grid_candidates': self.candidates}
+        return exported_arrays
+
+    @classmethod
+    def import_arrays(cls, arrays, clusters):
+        centers = cluster_centers(cluster_bounds(clusters))
+        return cls(centers, arrays['grid_bounds'].tolist(),
+                   arrays['grid_shape'].tolist(), arrays['grid_offsets'],
+                   arrays['grid_candidates'])
@@ -1,15 +1,17 @@
 from __future__ import division
 import numpy as np
 import json
-import operator
 from sklearn.preprocessing import Imputer
 from sklearn.decomposition import PCA
 from sklearn.cluster import KMeans
 from point import Point
 from item_cluster import ItemCluster
 from jester import *
-from jester.models import Joke
-from cluster import Cluster
+from cluster import Cluster, cluster_bounds, assign_clusters
+from cluster_grid import ClusterGrid
+from storage import save_arrays, load_arrays
+from sparse_ratings import issparse, to_csr, column_means, impute_columns, \
+    cluster_sums, item_embedding
 
 
 __author__ = 'Viraj Mahesh'
@@ -21,31 +23,45 @@ MOVING_AVERAGE_VECTOR_SIZE = 5
 
 class Eigentaste(object):
 
-    def __init__(self, train, gauge, levels=4):
+    def __init__(self, train, gauge, levels=4, joke_clusters=JOKE_CLUSTERS):
         """
         Initializes Eigentaste with a training set and gauge set.
 
-        :param train: The dataset on which Eigentaste must be trained.
+        :param train: The dataset on which Eigentaste must be trained. Either
+            a dense array in which missing ratings are NaN, or a scipy.sparse
+            matrix in which missing ratings are not stored. Sparse matrices
+            are never converted to a dense users x jokes matrix.
         :param gauge: List of indices that define the gauge set.
         :param levels: The number of recursive levels for user clustering.
+        :param joke_clusters: The number of joke clusters.
         :return: None
         """
         # Store training data and gauge set
-        self.train = train
+        self.sparse = issparse(train)
+        self.train = to_csr(train) if self.sparse else train
         self.gauge = gauge
         self.levels = levels
+        self.joke_cluster_count = joke_clusters
 
         # Store number of users and jokes
         self.users, self.jokes = self.train.shape
 
-        # Impute missing values using mean imputation
-        self.imputed_train = Imputer().fit_transform(self.train)
+        # Impute missing values using mean imputation. Sparse matrices are
+        # imputed on demand, using the mean rating of each joke.
+        if self.sparse:
+            self.means = column_means(self.train)
+            self.gauge_set_submatrix = impute_columns(self.train, gauge,
+                                                      self.means)
+        else:
+            self.imputed_train = Imputer().fit_transform(self.train)
+            self.gauge_set_submatrix = self.imputed_train[:, gauge]
 
         # Create a new PCA model and fit it to the training data (gauge set
         # sub-matrix). The PCA model will be used to project new users into the
-        # same plane as the rest of the data set.
-        self.gauge_set_submatrix = self.imputed_train[:, gauge]
-        self.pca_model = PCA()
+        # same plane as the rest of the data set. Users are clustered in the
+        # plane of the first two principal components, which are all of them
+        # for a gauge set of two jokes.
+        self.pca_model = PCA(n_components=2)
         self.pca_data = self.pca_model.fit_transform(self.gauge_set_submatrix)
 
         # Split the projected data recursively into clusters
@@ -56,7 +72,7 @@ class Eigentaste(object):
         self.predictions = self.calculate_predictions()
 
         # Split the jokes into joke clusters for dynamic recommendations
-        self.kmeans_model = KMeans(n_clusters=JOKE_CLUSTERS)
+        self.kmeans_model = KMeans(n_clusters=self.joke_cluster_count)
         self.joke_clusters = self.create_joke_clusters()
 
     def create_clusters(self):
@@ -93,33 +109,41 @@ class Eigentaste(object):
         clusters and returns a vector containing the cluster index of each joke.
         """
         predictions = np.array(self.predictions)
-        indices = self.kmeans_model.fit_predict(self.imputed_train.T)
+        if self.sparse:
+            jokes = item_embedding(self.train, self.means)
+        else:
+            jokes = self.imputed_train.T
+        indices = self.kmeans_model.fit_predict(jokes)
         return [ItemCluster(indices == idx, predictions) for idx
-                in range(JOKE_CLUSTERS)]
+                in range(self.joke_cluster_count)]
 
     def classify(self):
         """
         Classify users in the training set by assigning them to one of the clusters.
         """
-        indices = []
-        # Iterate through all users in the training set and assign them to clusters
-        for user in self.pca_data:
-            point = Point(*user)
-            # Iterate through each cluster to see if user is in the cluster
-            for idx, cluster in enumerate(self.clusters):
-                if point in cluster:
-                    indices.append(idx)
-                    break
-        # Convert to a numpy array for efficient operations
-        return np.array(indices)
+        # Assign all users at once, testing them against the cluster bounds
+        indices = assign_clusters(self.pca_data, cluster_bounds(self.clusters))
+        # Users that are not contained in any cluster are left out
+        return indices[indices >= 0]
 
     def calculate_predictions(self):
-        predictions = []
-        for idx in range(len(self.clusters)):
-            users = self.train[self.indices == idx]
-            ratings = np.nanmean(users, axis=0).tolist()
-            predictions.append(ratings)
-        return predictions
+        """
+        Computes the mean rating of each joke in each user cluster. The sums
+        and counts of the ratings are kept, so that new ratings can later be
+        folded into the predictions (see refresh_arrays).
+        """
+        if self.sparse:
+            self.rating_sums, self.rating_counts = cluster_sums(
+                self.train, self.indices, len(self.clusters))
+        else:
+            rated = ~np.isnan(self.train)
+            sums, counts = [], []
+            for idx in range(len(self.clusters)):
+                users = self.indices == idx
+                sums.append(np.nansum(self.train[users], axis=0))
+                counts.append(np.sum(rated[users], axis=0))
+            self.rating_sums, self.rating_counts = np.array(sums), np.array(counts)
+        return cluster_predictions(self.rating_sums, self.rating_counts).tolist()
 
     def export_model(self):
         pca_model = {'mean': self.pca_model.mean_.tolist(),
@@ -127,12 +151,136 @@ class Eigentaste(object):
         clusters = [cluster.export_model() for cluster in self.clusters]
         joke_clusters = [joke_cluster.export_model() for joke_cluster in
                          self.joke_clusters]
+        cluster_grid = ClusterGrid.build(self.clusters).export_model()
+        ranked_jokes = rank_jokes(self.joke_clusters).tolist()
         exported_model = {'pca model': pca_model,
                           'user clusters': clusters,
+                          'cluster grid': cluster_grid,
                           'joke clusters': joke_clusters,
+                          'ranked jokes': ranked_jokes,
                           'predictions': self.predictions}
         return exported_model
 
+    def export_arrays(self):
+        """
+        Exports the model as a dictionary of numpy arrays, which is the
+        representation used by the binary model format. Unlike export_model,
+        the predictions matrix is only stored once. Each joke cluster is
+        stored as a slice of the concatenated joke cluster arrays.
+        """
+        exported_arrays = {'pca_mean': self.pca_model.mean_,
+                           'pca_components': self.pca_model.components_,
+                           'user_clusters': cluster_bounds(self.clusters),
+                           'predictions': np.array(self.predictions),
+                           'rating_sums': self.rating_sums,
+                           'rating_counts': self.rating_counts}
+        exported_arrays.update(joke_cluster_arrays(self.joke_clusters))
+        exported_arrays.update(ClusterGrid.build(self.clusters).export_arrays())
+        return exported_arrays
+
+    def save(self, path):
+        """
+        Saves the model in the binary format, in the directory specified by
+        path. See storage.save_arrays for details.
+        """
+        save_arrays(self.export_arrays(), path)
+
+
+def cluster_predictions(rating_sums, rating_counts):
+    """
+    :return: The mean rating of each joke in each user cluster, which is NaN
+        for jokes that were not rated by any user of the cluster.
+    """
+    with np.errstate(invalid='ignore'):
+        return rating_sums / rating_counts
+
+
+def joke_cluster_arrays(joke_clusters):
+    """
+    Exports the joke clusters as arrays of the binary model format. Each joke
+    cluster is stored as a slice of the concatenated joke cluster arrays.
+    """
+    offsets = np.cumsum([0] + [joke_cluster.jokes for joke_cluster
+                               in joke_clusters])
+    indices = np.concatenate([joke_cluster.indices for joke_cluster
+                              in joke_clusters])
+    prediction_order = np.hstack([joke_cluster.prediction_order for
+                                  joke_cluster in joke_clusters])
+    averages = np.array([joke_cluster.averages for joke_cluster
+                         in joke_clusters])
+    return {'joke_cluster_indices': indices,
+            'joke_cluster_offsets': offsets,
+            'prediction_order': prediction_order,
+            'joke_cluster_averages': averages,
+            'ranked_jokes': rank_jokes(joke_clusters)}
+
+
+def refresh_arrays(arrays, user_cluster_ids, joke_ids, ratings):
+    """
+    Folds new ratings into a model in the binary format, without retraining
+    it. The ratings are added to the rating sums and counts of the user
+    clusters, from which the predictions, the joke cluster averages and the
+    ranked jokes are recomputed. The PCA model, the user clusters and the
+    joke clusters are left unchanged, so the cluster ids stored in the rater
+    states and in the jokes remain valid.
+
+    :param arrays: The arrays of the model, see Eigentaste.export_arrays.
+    :param user_cluster_ids: The user cluster id of the rater of each rating.
+    :param joke_ids: The id of the joke of each rating.
+    :param ratings: The value of each rating.
+    :return: The arrays of the refreshed model.
+    :raise ValueError: If the model does not store the rating sums and
+        counts, in which case it must be rebuilt.
+    """
+    if 'rating_sums' not in arrays:
+        raise ValueError('The model does not store rating sums and counts')
+    rating_sums = np.array(arrays['rating_sums'], dtype=np.float64)
+    rating_counts = np.array(arrays['rating_counts'], dtype=np.int64)
+    columns = np.asarray(joke_ids) - 1
+    # Jokes added after the model was built have no joke cluster
+    known = columns < rating_sums.shape[1]
+    cells = (np.asarray(user_cluster_ids)[known], columns[known])
+    np.add.at(rating_sums, cells, np.asarray(ratings)[known])
+    np.add.at(rating_counts, cells, 1)
+    predictions = cluster_predictions(rating_sums, rating_counts)
+
+    offsets = arrays['joke_cluster_offsets'].tolist()
+    joke_clusters = []
+    for start, end in zip(offsets, offsets[1:]):
+        members = np.zeros(rating_sums.shape[1], dtype=bool)
+        members[arrays['joke_cluster_indices'][start:end]] = True
+        joke_clusters.append(ItemCluster(members, predictions))
+
+    refreshed_arrays = dict(arrays)
+    refreshed_arrays.update(joke_cluster_arrays(joke_clusters))
+    refreshed_arrays.update({'predictions': predictions,
+                             'rating_sums': rating_sums,
+                             'rating_counts': rating_counts})
+    return refreshed_arrays
+
+
+def rank_jokes(joke_clusters):
+    """
+    Creates the table used to recommend jokes. For each user cluster and
+    joke cluster, the table contains the ids of the jokes in the joke cluster,
+    ranked from the highest to the lowest predicted rating. Rows of joke
+    clusters smaller than the largest one are padded with 0.
+
+    :param joke_clusters: The list of joke clusters.
+    :return: A user clusters x joke clusters x jokes array of joke ids, such
+        that ranked_jokes[u, i, n] is the joke recommended to a user of user
+        cluster u that has rated n jokes of joke cluster i.
+    """
+    user_clusters = len(joke_clusters[0].prediction_order)
+    max_jokes = max(joke_cluster.jokes for joke_cluster in joke_clusters)
+    ranked_jokes = np.zeros((user_clusters, len(joke_clusters), max_jokes),
+                            dtype=np.int32)
+    for idx, joke_cluster in enumerate(joke_clusters):
+        indices = np.asarray(joke_cluster.indices)
+        order = np.asarray(joke_cluster.prediction_order)[:, ::-1]
+        ranked_jokes[:, idx, :joke_cluster.jokes] = indices[order] + 1
+    return ranked_jokes
+
 
 class PCAModel(object):
     def __init__(self, model):
@@ -145,50 +293,129 @@ class PCAModel(object):
 
 
 class StoredEigentasteModel(object):
-    def __init__(self, json_string):
+    def __init__(self, json_string=None):
+        if json_string is None:
+            return
         model = json.loads(json_string)
         self.pca_model = PCAModel(model['pca model'])
         self.clusters = [Cluster.import_model(cluster) for cluster in
                          model['user clusters']]
+        # Models stored before the grid was exported need to build it here
+        if 'cluster grid' in model:
+            self.cluster_grid = ClusterGrid.import_model(model['cluster grid'],
+                                                         self.clusters)
+        else:
+            self.cluster_grid = ClusterGrid.build(self.clusters)
         self.joke_clusters = [ItemCluster.import_model(cluster) for cluster in
                               model['joke clusters']]
         self.predictions = model['predictions']
+        # Models stored before the ranked jokes were exported rank them here
+        if 'ranked jokes' in model:
+            self.ranked_jokes = np.array(model['ranked jokes'], dtype=np.int32)
+        else:
+            self.ranked_jokes = rank_jokes(self.joke_clusters)
+        self.joke_cluster_sizes = np.array([joke_cluster.jokes for joke_cluster
+                                            in self.joke_clusters])
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """
+        Creates a stored model from a dictionary of arrays in the binary
+        model format (see Eigentaste.export_arrays). Large arrays are used
+        without copying them, so memory mapped arrays stay shared.
+        """
+        stored_model = cls()
+        stored_model.pca_model = PCAModel({'mean': arrays['pca_mean'],
+                                           'components': arrays['pca_components']})
+        stored_model.clusters = [Cluster.import_bounds(bounds) for bounds in
+                                 arrays['user_clusters'].tolist()]
+        stored_model.cluster_grid = ClusterGrid.import_arrays(arrays,
+                                                              stored_model.clusters)
+        offsets = arrays['joke_cluster_offsets'].tolist()
+        stored_model.joke_clusters = [
+            ItemCluster.import_arrays(arrays['joke_cluster_indices'][start:end],
+                                      arrays['prediction_order'][:, start:end],
+                                      arrays['joke_cluster_averages'][idx])
+            for idx, (start, end) in enumerate(zip(offsets, offsets[1:]))
+        ]
+        stored_model.predictions = arrays['predictions']
+        if 'ranked_jokes' in arrays:
+            stored_model.ranked_jokes = arrays['ranked_jokes']
+        else:
+            stored_model.ranked_jokes = rank_jokes(stored_model.joke_clusters)
+        stored_model.joke_cluster_sizes = np.diff(offsets)
+        return stored_model
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a model saved in the binary format, memory mapping its arrays.
+        """
+        return cls.from_arrays(load_arrays(path))
 
     def transform(self, user):
         return self.pca_model.transform(user)
 
     def classify(self, user):
-        user = Point(*user)
-        distances = [cluster.distance(user) for cluster in self.clusters]
-        return np.argmin(distances)
+        """
+        Assigns a projected user to the cluster with the nearest midpoint,
+        using the precomputed cluster grid.
+        """
+        return self.cluster_grid.classify(user)
 
     def moving_averages(self, cluster_idx):
         return [[cluster.moving_averages(cluster_idx)]
                 * MOVING_AVERAGE_VECTOR_SIZE for cluster in self.joke_clusters]
 
     def recommend_joke(self, user):
-        def all_rated(n):
-            return user_model['jokes rated'][n] == self.joke_clusters[n].jokes
-
+        """
+        :return: The id of the joke recommended to the user.
+        """
         user_model = user.load_model()
-        moving_averages = user_model['moving averages']
-
-        averages = [(idx, np.mean(ratings)) for idx, ratings in
-                    enumerate(moving_averages) if not all_rated(idx)]
-
-        item_cluster_idx, average = max(averages, key=operator.itemgetter(1))
-        jokes_rated = user_model['jokes rated'][item_cluster_idx]
-        user_cluster_idx = user_model['user cluster id']
+        joke_ids, item_cluster_idx, averages = self.recommend_jokes(
+            [user_model.user_cluster_id], user_model.jokes_rated[np.newaxis],
+            user_model.moving_averages[np.newaxis])
 
-        item_cluster = self.joke_clusters[item_cluster_idx]
-        joke_id = item_cluster.recommend(user_cluster_idx, jokes_rated) + 1
+        available = user_model.jokes_rated < self.joke_cluster_sizes
+        log_averages(user, [(idx, average) for idx, average in
+                            enumerate(averages[0]) if available[idx]])
+        log_cluster_choice(user, item_cluster_idx[0],
+                           averages[0, item_cluster_idx[0]])
 
-        log_averages(user, averages)
-        log_cluster_choice(user, item_cluster_idx, average)
+        return int(joke_ids[0])
 
-        return Joke.objects.get(id=joke_id)
-
-    def get_prediction(self, user, joke):
+    def recommend_jokes(self, user_cluster_ids, jokes_rated, moving_averages):
+        """
+        Recommends a joke to each user of a batch of users. The joke cluster
+        with the highest moving average, among those that have not been fully
+        rated, is chosen and its next joke is looked up in the ranked jokes.
+
+        :param user_cluster_ids: Array with the user cluster id of each user.
+        :param jokes_rated: Users x joke clusters array of jokes rated.
+        :param moving_averages: Users x joke clusters x moving average vector
+            size array of moving averages.
+        :return: A tuple of arrays, with the id of the recommended joke and the
+            index of the chosen joke cluster for each user, and the users x
+            joke clusters mean of the moving averages.
+        """
+        jokes_rated = np.asarray(jokes_rated, dtype=np.intp)
+        averages = np.mean(moving_averages, axis=2)
+        # Joke clusters without an average or without unrated jokes are
+        # never chosen
+        scores = np.where(np.isnan(averages), -np.inf, averages)
+        scores[jokes_rated >= self.joke_cluster_sizes] = -np.inf
+        item_cluster_idx = np.argmax(scores, axis=1)
+        users = np.arange(len(item_cluster_idx))
+        joke_ids = self.ranked_jokes[np.asarray(user_cluster_ids), item_cluster_idx,
+                                     jokes_rated[users, item_cluster_idx]]
+        return joke_ids, item_cluster_idx, averages
+
+    def get_prediction(self, user, joke_id):
         user_model = user.load_model()
-        cluster_id = user_model['user cluster id']
-        return self.predictions[cluster_id][joke.id - 1]
\ No newline at end of file
+        return self.predict(user_model.user_cluster_id, joke_id)
+
+    def predict(self, user_cluster_id, joke_id):
+        """
+        :return: The predicted rating of a joke for users in a user cluster.
+        """
+        return self.predictions[user_cluster_id][joke_id - 1]
\ No newline at end of file
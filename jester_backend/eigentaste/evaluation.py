@@ -0,0 +1,171 @@
+from __future__ import division
+import numpy as np
+import time
+from cluster import cluster_bounds
+from cluster_grid import cluster_centers, nearest_clusters
+from eigentaste import MOVING_AVERAGE_VECTOR_SIZE
+
+
+__author__ = 'Viraj Mahesh'
+
+
+# Difference between the highest and the lowest possible rating
+RATING_RANGE = 20.0
+
+
+def split_users(users, test_fraction, seed=0):
+    """
+    Randomly splits the users of a ratings matrix into training and test
+    users. The same seed always gives the same split, so that models trained
+    with different parameters are evaluated on the same users.
+
+    :param users: The number of users (i.e rows) in the ratings matrix.
+    :param test_fraction: The expected fraction of users held out for testing.
+    :param seed: The seed of the random number generator.
+    :return: A tuple of arrays (training rows, test rows), in ascending order.
+    """
+    test = np.random.RandomState(seed).rand(users) < test_fraction
+    return np.flatnonzero(~test), np.flatnonzero(test)
+
+
+def assign_users(model, ratings):
+    """
+    Assigns users that were not part of the training set to user clusters,
+    in the same way as new raters are assigned: their gauge set ratings are
+    projected with PCA and the cluster with the nearest midpoint is chosen.
+    Missing gauge set ratings are replaced by the mean of the training set.
+
+    :param model: A trained Eigentaste model.
+    :param ratings: A dense users x jokes ratings matrix.
+    :return: An array with the user cluster index of each user.
+    """
+    gauge = np.array(ratings[:, model.gauge], dtype=np.float64)
+    missing = np.isnan(gauge)
+    gauge[missing] = model.pca_model.mean_[np.nonzero(missing)[1]]
+    points = model.pca_model.transform(gauge)
+    centers = cluster_centers(cluster_bounds(model.clusters))
+    return nearest_clusters(points, centers)
+
+
+def held_out_error(model, ratings, rows, chunk_size=10000):
+    """
+    Computes the normalized mean absolute error (NMAE) of the predictions of
+    a model for held-out users. Each user is assigned to a cluster using the
+    gauge set, and the ratings of all other jokes are compared with the
+    predictions of that cluster. Ratings without a prediction are skipped.
+
+    :param model: A trained Eigentaste model.
+    :param ratings: A dense ratings matrix, where missing ratings are NaN.
+    :param rows: The indices of the held-out users.
+    :param chunk_size: The number of users evaluated at a time.
+    :return: A tuple (NMAE, number of ratings compared).
+    """
+    predictions = np.array(model.predictions)
+    total, count = 0.0, 0
+    for start in xrange(0, len(rows), chunk_size):
+        chunk = np.array(ratings[rows[start:start + chunk_size]],
+                         dtype=np.float64)
+        predicted = predictions[assign_users(model, chunk)]
+        chunk[:, model.gauge] = np.nan
+        known = ~np.isnan(chunk) & ~np.isnan(predicted)
+        total += np.sum(np.abs(predicted[known] - chunk[known]))
+        count += int(np.sum(known))
+    if count == 0:
+        return np.nan, 0
+    return total / count / RATING_RANGE, count
+
+
+def replay(model, ratings, rows, gauge, steps, chunk_size=20000):
+    """
+    Replays held-out users through the recommendation loop of the server:
+    each user rates the gauge set, is assigned to a user cluster, and is
+    then recommended jokes by the moving averages of the joke clusters (see
+    StoredEigentasteModel.recommend_jokes). The users are simulated in
+    batches, one recommendation per user at each step. A recommended joke is
+    rated with the held-out rating of the user; jokes the user did not rate
+    count as seen, but do not change the moving averages. Users that did not
+    rate the whole gauge set are skipped, as are random joke requests.
+
+    :param model: A StoredEigentasteModel.
+    :param ratings: A dense ratings matrix, where missing ratings are NaN.
+    :param rows: The indices of the users to replay.
+    :param gauge: The joke indices of the gauge set the model was trained on.
+    :param steps: The number of jokes recommended to each user.
+    :param chunk_size: The number of users simulated at a time.
+    :return: A dictionary with the number of users, recommendations and
+        rated recommendations, the NMAE of the predictions of the rated
+        recommendations, the hit rate (the fraction of rated recommendations
+        that were rated positively), and the compute time of a step, per
+        batch and per user. The NMAE and the hit rate are NaN when nothing
+        could be compared, as in held_out_error.
+    """
+    gauge = np.asarray(gauge)
+    sizes = model.joke_cluster_sizes
+    averages = np.array([joke_cluster.averages for joke_cluster
+                         in model.joke_clusters], dtype=np.float32).T
+    joke_cluster_ids = np.empty(len(model.predictions[0]), dtype=np.intp)
+    for idx, joke_cluster in enumerate(model.joke_clusters):
+        joke_cluster_ids[np.asarray(joke_cluster.indices)] = idx
+    predictions = np.asarray(model.predictions)
+    totals = {'users': 0, 'recommendations': 0, 'rated': 0, 'hits': 0,
+              'error': 0.0, 'predicted': 0, 'time': 0.0, 'batches': 0}
+
+    for start in xrange(0, len(rows), chunk_size):
+        chunk = np.array(ratings[rows[start:start + chunk_size]],
+                         dtype=np.float64)
+        chunk = chunk[~np.any(np.isnan(chunk[:, gauge]), axis=1)]
+        users = np.arange(len(chunk))
+        cluster_ids = nearest_clusters(model.transform(chunk[:, gauge]),
+                                       model.cluster_grid.centers)
+        moving_averages = np.repeat(averages[cluster_ids][:, :, np.newaxis],
+                                    MOVING_AVERAGE_VECTOR_SIZE, axis=2)
+        jokes_rated = np.zeros((len(chunk), len(sizes)), dtype=np.intp)
+        positions = np.zeros_like(jokes_rated)
+
+        def rate(users, joke_idx, values):
+            joke_cluster_idx = joke_cluster_ids[joke_idx]
+            known = ~np.isnan(values)
+            cells = (users[known], joke_cluster_idx[known])
+            moving_averages[cells + (positions[cells],)] = values[known]
+            positions[cells] = (positions[cells] + 1) % MOVING_AVERAGE_VECTOR_SIZE
+            jokes_rated[users, joke_cluster_idx] += 1
+
+        for joke_idx in gauge:
+            rate(users, np.repeat(joke_idx, len(users)), chunk[:, joke_idx])
+
+        for _ in range(steps):
+            # Users stop once no joke cluster can be recommended
+            available = ((jokes_rated < sizes) &
+                         ~np.isnan(np.mean(moving_averages, axis=2)))
+            users = np.flatnonzero(np.any(available, axis=1))
+            if len(users) == 0:
+                break
+            began = time.time()
+            joke_ids, _, _ = model.recommend_jokes(
+                cluster_ids[users], jokes_rated[users], moving_averages[users])
+            joke_idx = joke_ids - 1
+            values = chunk[users, joke_idx]
+            rate(users, joke_idx, values)
+            totals['time'] += time.time() - began
+            totals['batches'] += 1
+
+            predicted = predictions[cluster_ids[users], joke_idx]
+            known = ~np.isnan(values)
+            compared = known & ~np.isnan(predicted)
+            totals['recommendations'] += len(users)
+            totals['rated'] += int(np.sum(known))
+            totals['hits'] += int(np.sum(values[known] > 0))
+            totals['error'] += np.sum(np.abs(predicted[compared] -
+                                             values[compared]))
+            totals['predicted'] += int(np.sum(compared))
+        totals['users'] += len(chunk)
+
+    return {'users': totals['users'],
+            'recommendations': totals['recommendations'],
+            'rated': totals['rated'],
+            'nmae': totals['error'] / totals['predicted'] / RATING_RANGE
+            if totals['predicted'] else np.nan,
+            'hit rate': totals['hits'] / totals['rated'] if totals['rated']
+            else np.nan,
+            'batch step time': totals['time'] / max(totals['batches'], 1),
+            'user step time': totals['time'] / max(totals['recommendations'], 1)}
@@ -34,6 +34,21 @@ class ItemCluster(object):
         item_cluster.averages = np.array(model['averages'])
         return item_cluster
 
+    @classmethod
+    def import_arrays(cls, indices, prediction_order, averages):
+        """
+        Creates an item cluster from arrays of the binary model format. The
+        arrays are used as they are (i.e no copy is made), and per-cluster
+        predictions are not kept since they are only needed for training.
+        """
+        item_cluster = cls()
+        item_cluster.indices = indices
+        item_cluster.jokes = len(indices)
+        item_cluster.predictions = None
+        item_cluster.prediction_order = prediction_order
+        item_cluster.averages = averages
+        return item_cluster
+
     def recommend(self, user_cluster_id, jokes_rated):
         return self.indices[
             self.prediction_order[user_cluster_id][-jokes_rated - 1]
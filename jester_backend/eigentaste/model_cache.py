@@ -0,0 +1,66 @@
+import threading
+from jester.models import RecommenderModel
+from eigentaste import StoredEigentasteModel
+
+
+__author__ = 'Viraj Mahesh'
+
+
+class ModelCache(object):
+    """
+    Process-local cache of the deserialized recommender model. The cached
+    model is keyed by the id of the RecommenderModel row it was loaded from,
+    so publishing a new RecommenderModel (i.e a new version) causes the next
+    lookup to reload it. Safe to share between threads.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.model = None
+
+    @staticmethod
+    def latest_version():
+        """
+        :return: The id of the most recently published RecommenderModel.
+        """
+        versions = (RecommenderModel.objects.order_by('-id').
+                    values_list('id', flat=True)[:1])
+        if not versions:
+            raise RecommenderModel.DoesNotExist('No recommender model stored')
+        return versions[0]
+
+    def get(self):
+        """
+        :return: The StoredEigentasteModel for the latest RecommenderModel,
+            only loading it from the db if a new version has been published.
+        """
+        version = self.latest_version()
+        # Read both attributes under the lock so that a concurrent reload
+        # cannot hand out a model that does not match the version.
+        with self.lock:
+            if self.version == version:
+                return self.model
+        recommender_model = RecommenderModel.objects.get(id=version)
+        if recommender_model.path:
+            model = StoredEigentasteModel.load(recommender_model.path)
+        else:
+            model = StoredEigentasteModel(recommender_model.data)
+        with self.lock:
+            # Another thread may have loaded a newer version in the meantime
+            if self.version is None or self.version < version:
+                self.version, self.model = version, model
+            return self.model
+
+    def clear(self):
+        with self.lock:
+            self.version = self.model = None
+
+
+model_cache = ModelCache()
+
+
+def get_stored_model():
+    """
+    :return: The cached StoredEigentasteModel for the latest model version.
+    """
+    return model_cache.get()
@@ -0,0 +1,144 @@
+"""
+Training helpers for sparse ratings matrices, in which only the ratings that
+exist are stored and missing ratings are left out (a stored 0 is a rating of
+0). They compute the same quantities as the dense code path, which works on a
+matrix where missing ratings are NaN, without creating a dense users x jokes
+matrix.
+"""
+
+from __future__ import division
+import numpy as np
+from scipy.sparse import csr_matrix, issparse
+
+
+__author__ = 'Viraj Mahesh'
+
+
+def to_csr(train):
+    """
+    :return: The ratings matrix in CSR format, with float64 ratings.
+    """
+    return csr_matrix(train, dtype=np.float64)
+
+
+def from_dense(ratings, rows, chunk_size=10000):
+    """
+    Converts rows of a dense ratings matrix, where missing ratings are NaN,
+    to a CSR matrix. The rows are converted in chunks, so that ratings can be
+    a memory mapped matrix much larger than the available memory.
+
+    :param ratings: A dense ratings matrix.
+    :param rows: The indices of the rows to convert, in ascending order.
+    :param chunk_size: The number of rows converted at a time.
+    :return: A len(rows) x jokes CSR matrix.
+    """
+    data, indices, counts = [], [], [np.zeros(1, dtype=np.int64)]
+    for start in xrange(0, len(rows), chunk_size):
+        chunk = np.asarray(ratings[rows[start:start + chunk_size]],
+                           dtype=np.float64)
+        known = ~np.isnan(chunk)
+        # nonzero lists the ratings row by row, as CSR does
+        row, column = np.nonzero(known)
+        data.append(chunk[row, column])
+        indices.append(column)
+        counts.append(np.sum(known, axis=1))
+    indptr = np.cumsum(np.concatenate(counts))
+    data = np.concatenate(data) if data else np.zeros(0)
+    indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64)
+    return csr_matrix((data, indices, indptr),
+                      shape=(len(rows), ratings.shape[1]))
+
+
+def rated(train):
+    """
+    :return: A matrix with the same structure as train where each stored
+        rating is replaced by 1.
+    """
+    indicator = train.copy()
+    indicator.data = np.ones_like(indicator.data)
+    return indicator
+
+
+def column_means(train):
+    """
+    Computes the mean of the ratings of each joke, i.e the values used for
+    mean imputation. Jokes without any rating get a mean of 0.
+
+    :param train: A CSR ratings matrix.
+    :return: An array containing the mean rating of each joke.
+    """
+    sums = np.asarray(train.sum(axis=0)).ravel()
+    counts = np.asarray(rated(train).sum(axis=0)).ravel()
+    # Jokes without ratings have a sum of 0
+    return sums / np.maximum(counts, 1)
+
+
+def impute_columns(train, columns, means):
+    """
+    Extracts a set of columns of the ratings matrix as a dense matrix, where
+    missing ratings are replaced by the mean rating of the joke.
+
+    :param train: A CSR ratings matrix.
+    :param columns: The indices of the columns to extract (e.g the gauge set).
+    :param means: The mean rating of each joke, see column_means.
+    :return: A users x len(columns) array.
+    """
+    columns = np.asarray(columns)
+    # Column indexing may drop stored ratings of 0, so the stored ratings
+    # are copied from the CSR arrays directly
+    lookup = np.empty(train.shape[1], dtype=np.intp)
+    lookup.fill(-1)
+    lookup[columns] = np.arange(len(columns))
+    rows = np.repeat(np.arange(train.shape[0]), np.diff(train.indptr))
+    positions = lookup[train.indices]
+    selected = positions >= 0
+    submatrix = np.tile(means[columns], (train.shape[0], 1))
+    submatrix[rows[selected], positions[selected]] = train.data[selected]
+    return submatrix
+
+
+def cluster_sums(train, indices, clusters):
+    """
+    Computes the sum and the number of the ratings of each joke over the
+    users of each cluster. This is the sparse equivalent of calling np.nansum
+    on the rows of each cluster, and counting the ratings that are not NaN.
+
+    :param train: A CSR ratings matrix.
+    :param indices: The index of the cluster of each user.
+    :param clusters: The number of clusters.
+    :return: A tuple of clusters x jokes arrays (sums, counts).
+    """
+    users = len(indices)
+    # membership[c, u] is 1 if user u belongs to cluster c
+    membership = csr_matrix((np.ones(users), (indices, np.arange(users))),
+                            shape=(clusters, train.shape[0]))
+    sums = (membership * train).toarray()
+    counts = (membership * rated(train)).toarray().astype(np.int64)
+    return sums, counts
+
+
+def item_embedding(train, means):
+    """
+    Embeds the jokes in a space where the distance between two jokes is the
+    distance between their columns in the mean imputed ratings matrix, so
+    that clustering the embedded jokes gives the same clusters as clustering
+    the columns of the imputed matrix.
+
+    The imputed matrix is X = 1 m' + E, where m holds the mean of each joke
+    and E is sparse, holding rating - mean for each stored rating. Since each
+    column of E sums to 0, the Gram matrix of the jokes is X'X = E'E + n m m',
+    where n is the number of users. Factorizing the jokes x jokes Gram matrix
+    gives the embedding.
+
+    :param train: A CSR ratings matrix.
+    :param means: The mean rating of each joke, see column_means.
+    :return: A jokes x jokes array, where row j is the embedding of joke j.
+    """
+    deviations = train.copy()
+    deviations.data = deviations.data - means[deviations.indices]
+    gram = (deviations.T * deviations).toarray()
+    gram += train.shape[0] * np.outer(means, means)
+    eigenvalues, eigenvectors = np.linalg.eigh(gram)
+    # Eigenvalues are nonnegative, up to rounding errors
+    return eigenvectors * np.sqrt(np.maximum(eigenvalues, 0))
+
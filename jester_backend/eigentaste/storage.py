@@ -0,0 +1,75 @@
+import numpy as np
+import os
+import shutil
+import tempfile
+
+
+__author__ = 'Viraj Mahesh'
+
+
+# Data type of every array in the binary model format. Large arrays are
+# stored as float32/int32 to keep the files (and the mapped pages) compact.
+MODEL_ARRAYS = {
+    'pca_mean': np.float64,
+    'pca_components': np.float64,
+    'user_clusters': np.float64,
+    'predictions': np.float32,
+    'rating_sums': np.float64,
+    'rating_counts': np.int32,
+    'joke_cluster_indices': np.int32,
+    'joke_cluster_offsets': np.int32,
+    'prediction_order': np.int32,
+    'joke_cluster_averages': np.float32,
+    'ranked_jokes': np.int32,
+    'grid_bounds': np.float64,
+    'grid_shape': np.int32,
+    'grid_offsets': np.int32,
+    'grid_candidates': np.int32,
+}
+
+
+def save_arrays(arrays, path):
+    """
+    Saves a recommender model in the binary format. The model is stored as a
+    directory containing one .npy file per array, so that it can later be
+    memory mapped. The directory is written to a temporary location first and
+    then renamed, so that readers never see a partially written model.
+
+    :param arrays: A dictionary mapping array names to numpy arrays.
+    :param path: The directory in which the model must be stored. Must not
+        exist yet.
+    :return: None
+    """
+    parent = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    staging = tempfile.mkdtemp(dir=parent)
+    try:
+        for name, array in arrays.items():
+            dtype = MODEL_ARRAYS.get(name, None)
+            array = np.ascontiguousarray(array, dtype=dtype)
+            np.save(os.path.join(staging, name + '.npy'), array)
+        os.rename(staging, path)
+    except:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+
+def load_arrays(path, mmap=True):
+    """
+    Loads a recommender model stored in the binary format.
+
+    :param path: The directory in which the model is stored.
+    :param mmap: If True, the arrays are memory mapped read-only instead of
+        being read into memory. All processes that map the same model share
+        the same physical pages.
+    :return: A dictionary mapping array names to numpy arrays.
+    """
+    mmap_mode = 'r' if mmap else None
+    arrays = {}
+    for filename in os.listdir(path):
+        name, extension = os.path.splitext(filename)
+        if extension == '.npy':
+            arrays[name] = np.load(os.path.join(path, filename),
+                                   mmap_mode=mmap_mode)
+    return arrays
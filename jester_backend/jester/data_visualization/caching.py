@@ -0,0 +1,118 @@
+import hashlib
+import time
+from functools import wraps
+from datetime import datetime, time as day_start
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Max
+from django.utils import timezone
+from django.views.decorators.http import condition
+from jester.models import CacheVersion, Rater, Rating
+
+
+__author__ = 'Viraj Mahesh'
+
+
+STATE_KEY = 'data_visualization:state'
+
+# Name of the CacheVersion of the data shown by the views. It is stored in
+# the db so that invalidating the responses from any process (e.g the rollup
+# cron job) reaches every web server, whatever the cache backend.
+DATA_VISUALIZATION = 'data visualization'
+
+# Attribute of the request in which the validators of the response are kept
+VALIDATORS_ATTRIBUTE = '_data_visualization_validators'
+
+
+def current_mark():
+    """
+    :return: The high-water mark of the raw tables read by the
+        data_visualization views, which changes whenever new ratings or
+        raters are stored.
+    """
+    return '{0}-{1}'.format(
+        Rating.objects.aggregate(Max('id'))['id__max'] or 0,
+        Rater.objects.aggregate(Max('id'))['id__max'] or 0)
+
+
+def high_water_mark():
+    """
+    Returns the high-water mark of the data. The version is read on every
+    call, while the mark of the raw tables is cached and only recomputed
+    once it is older than DATA_VISUALIZATION_CACHE_TTL seconds, or when the
+    version changes.
+
+    :return: A tuple (mark, time at which the mark last changed).
+    """
+    version = CacheVersion.current(DATA_VISUALIZATION)
+    state = cache.get(STATE_KEY)
+    now = time.time()
+    if (state is None or state['version'] != version or
+            now - state['checked'] >= settings.DATA_VISUALIZATION_CACHE_TTL):
+        mark = '{0}-{1}'.format(current_mark(), version)
+        if state is None or state['mark'] != mark:
+            state = {'mark': mark, 'modified': now}
+        state['version'], state['checked'] = version, now
+        cache.set(STATE_KEY, state, None)
+    return state['mark'], state['modified']
+
+
+def invalidate_data_visualization():
+    """
+    Invalidates every cached response, in every process, by changing the
+    version of the data.
+    """
+    CacheVersion.invalidate(DATA_VISUALIZATION)
+
+
+def validators(request):
+    """
+    Computes the ETag and the Last-Modified time of the response to a
+    request, once per request. The ETag identifies the view, its query
+    parameters, the high-water mark and the current date (which some views
+    depend on). Since responses change with the date, the Last-Modified time
+    is never earlier than the start of the current day, so that clients
+    which only send If-Modified-Since do not keep the response of a
+    previous day.
+
+    :return: A tuple (ETag, Last-Modified time).
+    """
+    if not hasattr(request, VALIDATORS_ATTRIBUTE):
+        mark, modified = high_water_mark()
+        today = timezone.now().date()
+        key = [request.path, sorted(request.GET.items()), mark, today]
+        setattr(request, VALIDATORS_ATTRIBUTE,
+                (hashlib.md5(repr(key)).hexdigest(),
+                 max(datetime.utcfromtimestamp(modified),
+                     datetime.combine(today, day_start()))))
+    return getattr(request, VALIDATORS_ATTRIBUTE)
+
+
+def response_etag(request, *args, **kwargs):
+    return validators(request)[0]
+
+
+def response_last_modified(request, *args, **kwargs):
+    return validators(request)[1]
+
+
+def cached_view(view):
+    """
+    Caches the responses of a view, keyed by their ETag (see validators), for
+    DATA_VISUALIZATION_CACHE_TTL seconds. Responses carry an ETag and a
+    Last-Modified header, and conditional requests for an unchanged response
+    get a 304 response after a single query, the lookup of the version of
+    the data (see CacheVersion). The lookup is what lets an invalidation
+    reach every process without a shared cache backend.
+    """
+    @condition(etag_func=response_etag, last_modified_func=response_last_modified)
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        key = 'data_visualization:response:' + response_etag(request)
+        response = cache.get(key)
+        if response is None:
+            response = view(request, *args, **kwargs)
+            if response.status_code == 200:
+                cache.set(key, response, settings.DATA_VISUALIZATION_CACHE_TTL)
+        return response
+    return wrapper
@@ -4,4 +4,5 @@ import views
 urlpatterns = patterns('',
     url(r'^rating_histogram/$', views.rating_histogram),
     url(r'^num_ratings_histogram/$', views.num_ratings_histogram),
-    url(r'^num_ratings_over_time/$', views.num_ratings_over_time))
\ No newline at end of file
+    url(r'^num_ratings_over_time/$', views.num_ratings_over_time),
+    url(r'^top_jokes/$', views.top_jokes))
\ No newline at end of file
@@ -1,6 +1,10 @@
 from __future__ import division
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseBadRequest
+from django.db.models import Count, Sum
 from jester.models import *
+from jester.rollups import BINS, BIN_WIDTH, MIN_RATING, MAX_RATING, \
+    rating_bin_edges, histogram_median, top_jokes as rank_jokes
+from jester.data_visualization.caching import cached_view
 from distutils.util import strtobool
 from datetime import datetime, timedelta
 from collections import OrderedDict
@@ -10,62 +14,103 @@ import numpy as np
 __author__ = 'Viraj Mahesh'
 
 
-def freedman_diaconis(v):
+def weighted_percentile(values, weights, q):
+    """
+    Computes a percentile of a set of distinct values, each repeated a number
+    of times, without expanding them. Gives the same result as np.percentile
+    applied to the expanded values (i.e with linear interpolation).
+
+    :param values: The distinct values, in ascending order.
+    :param weights: The number of times each value is repeated.
+    :param q: The percentile, from 0 to 100.
+    """
+    cumulative = np.cumsum(weights)
+    position = q / 100 * (cumulative[-1] - 1)
+    lower, upper = int(np.floor(position)), int(np.ceil(position))
+    # Index of the value at each position of the expanded values
+    lower_value = values[np.searchsorted(cumulative, lower, side='right')]
+    upper_value = values[np.searchsorted(cumulative, upper, side='right')]
+    return lower_value + (position - lower) * (upper_value - lower_value)
+
+
+def freedman_diaconis(v, weights=None):
     """Uses the Freedman-Diaconis rule to calculate number of bins and bin width"""
+    if weights is None:
+        v, weights = np.unique(v, return_counts=True)
 
     def IQR(v):
-        return np.percentile(v, 75) - np.percentile(v, 25)
+        return (weighted_percentile(v, weights, 75) -
+                weighted_percentile(v, weights, 25))
 
-    h = (2 * IQR(v) * (len(v)) ** (-1 / 3))
+    h = (2 * IQR(v) * (np.sum(weights)) ** (-1 / 3))
     range = np.max(v) - np.min(v)
     bins = int(range / h)
     return bins, range / bins
 
 
+@cached_view
 def rating_histogram(request):
-    start_date = datetime.strptime(request.GET.get('start_date'), '%m/%d/%Y')
-    end_date = datetime.strptime(request.GET.get('end_date'), '%m/%d/%Y')
+    """
+    Histogram of the ratings made between two dates (inclusive), computed
+    from the daily rating rollups. The histogram uses the fixed bins of the
+    rollups, and the median is estimated from the histogram.
+    """
+    start_date = datetime.strptime(request.GET.get('start_date'), '%m/%d/%Y').date()
+    end_date = datetime.strptime(request.GET.get('end_date'), '%m/%d/%Y').date()
     filter_null = strtobool(request.GET.get('filter_null'))
-    ratings = map(Rating.to_float,
-                  Rating.objects.filter(timestamp__gte=start_date, timestamp__lte=end_date))
-
-    if filter_null:
-        ratings = filter(lambda x: x != 0, ratings)
-    bins, width = 20, 1  # Hardcoded number of bins. Works better
-    hist, bin_edges = np.histogram(ratings, bins=bins)
-    hist, bin_edges = hist.tolist(), bin_edges.tolist()
+    summaries = (RatingRollup.objects.
+                 filter(date__gte=start_date, date__lte=end_date).
+                 values('bin').annotate(ratings=Sum('count'), sum=Sum('total'),
+                                        zero_ratings=Sum('zeros')))
+
+    bins, width = BINS, BIN_WIDTH
+    hist, total = np.zeros(bins, dtype=np.int64), 0.0
+    for summary in summaries:
+        hist[summary['bin']] += summary['ratings']
+        total += summary['sum']
+        if filter_null:
+            hist[summary['bin']] -= summary['zero_ratings']
+    num_ratings, edges = int(np.sum(hist)), rating_bin_edges()
+    median = histogram_median(hist, edges)
+    hist, edges = hist.tolist(), edges.tolist()
 
     response = {
-        'heights': zip(np.add(bin_edges, width / 2), hist),
+        'heights': zip(np.add(edges, width / 2), hist),
         'yAxis': {
             'min': 0,
             'max': np.max(hist)
         },
         'xAxis': {
-            'min': -10.0,
-            'max': 10.0,
-            'tickPositions': bin_edges
+            'min': MIN_RATING,
+            'max': MAX_RATING,
+            'tickPositions': edges
         },
         'stats': {
             'bins': bins,
             'bin_width': width,
-            'num_ratings': len(ratings),
-            'mean_rating': np.mean(ratings),
-            'median_rating': np.median(ratings)
+            'num_ratings': num_ratings,
+            'mean_rating': total / num_ratings if num_ratings else np.nan,
+            'median_rating': median
         }
     }
     return HttpResponse(json.dumps(response), content_type='application/json')
 
 
+@cached_view
 def num_ratings_histogram(request):
     filter_null = strtobool(request.GET.get('filter_null'))
-    num_ratings = map(Rater.num_jokes_rated, Rater.objects.all())
-
+    raters = Rater.objects.all()
     if filter_null:
-        num_ratings = filter(lambda x: x != 0, num_ratings)
-    bins, width = freedman_diaconis(num_ratings)
-    hist, bin_edges = np.histogram(num_ratings, bins=bins)
-    hist, bin_edges = hist.tolist(), bin_edges.tolist()
+        raters = raters.exclude(jokes_rated=0)
+    # Count the raters that rated each number of jokes in the db, so only
+    # one row per distinct number of jokes rated is returned
+    counts = raters.values_list('jokes_rated').annotate(
+        raters=Count('id')).order_by('jokes_rated')
+    num_ratings, weights = [np.array(column) for column in zip(*counts)]
+
+    bins, width = freedman_diaconis(num_ratings, weights)
+    hist, bin_edges = np.histogram(num_ratings, bins=bins, weights=weights)
+    hist, bin_edges = hist.astype(np.int64).tolist(), bin_edges.tolist()
 
     response = {
         'heights': zip(np.add(bin_edges, width / 2), hist),
@@ -81,27 +126,30 @@ def num_ratings_histogram(request):
         'stats': {
             'bins': bins,
             'bin_width': width,
-            'num_ratings': len(num_ratings),
-            'mean_num_ratings': np.mean(num_ratings),
-            'median_rating': np.median(num_ratings)
+            'num_ratings': int(np.sum(weights)),
+            'mean_num_ratings': np.average(num_ratings, weights=weights),
+            'median_rating': weighted_percentile(num_ratings, weights, 50)
         }
     }
     return HttpResponse(json.dumps(response), content_type='application/json')
 
 
+@cached_view
 def num_ratings_over_time(request):
     delta = timedelta(days=1)
     now = datetime(day=1, month=4, year=2015).date()
     end = datetime.now().date()
 
     counts = OrderedDict()
+    days = (RatingRollup.objects.filter(date__gte=now, date__lte=end).
+            values('date').annotate(ratings=Sum('count')))
 
     while now <= end:
         counts[now] = 0
         now += delta
 
-    for rating in Rating.objects.all():
-        counts[rating.date()] += 1
+    for day in days:
+        counts[day['date']] = day['ratings']
 
     dates, ratings = counts.keys(), counts.values()
     dates = map(lambda x: x.strftime('%d-%b-%y'), dates)
@@ -119,4 +167,27 @@ def num_ratings_over_time(request):
     return HttpResponse(json.dumps(response), content_type='application/json')
 
 
-
+@cached_view
+def top_jokes(request):
+    """
+    Returns the jokes with the highest mean rating or rating variance.
+
+    Query parameters:
+        order_by: Either 'mean' (the default) or 'variance'.
+        n: The number of jokes to return, 10 by default.
+
+    :return: A JSON formatted HTTP response, containing a list of jokes with
+        the following fields: joke_id, mean, variance and num_ratings.
+    """
+    order_by = request.GET.get('order_by', 'mean')
+    try:
+        n = int(request.GET.get('n', 10))
+    except ValueError:
+        return HttpResponseBadRequest('n must be an integer')
+    if order_by not in ('mean', 'variance') or n < 0:
+        return HttpResponseBadRequest('Invalid order_by or n')
+
+    jokes = [{'joke_id': joke_id, 'mean': mean, 'variance': variance,
+              'num_ratings': count} for joke_id, mean, variance, count
+             in rank_jokes(order_by, n)]
+    return HttpResponse(json.dumps(jokes), content_type='application/json')
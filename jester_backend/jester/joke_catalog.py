@@ -0,0 +1,121 @@
+import json
+import numpy as np
+import threading
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from jester.models import CacheVersion, Joke
+from jester.joke_sampler import JokeSampler
+
+
+__author__ = 'Viraj Mahesh'
+
+
+# Name of the CacheVersion of the joke catalogs. The version is kept in the
+# db so that a change made by any process on any host reaches every process.
+JOKE_CATALOG = 'joke catalog'
+
+
+class JokeCatalog(object):
+    """
+    In-memory copy of all jokes, so that serving and rating jokes does not
+    query the jester_joke table. For each joke the catalog holds a Joke
+    instance, the JSON encoded part of the request_joke response and the
+    index of its joke cluster.
+    """
+    def __init__(self, jokes, old_jokes):
+        """
+        :param jokes: A list of (id, joke text, model params) tuples.
+        :param old_jokes: The number of old jokes, see JokeSampler.
+        """
+        self.jokes = {}
+        self.responses = {}
+        max_id = max([joke_id for joke_id, _, _ in jokes] or [0])
+        self.cluster_ids = np.empty(max_id + 1, dtype=np.int16)
+        self.cluster_ids.fill(-1)
+        for joke_id, joke_text, model_params in jokes:
+            self.jokes[joke_id] = Joke(id=joke_id, joke_text=joke_text,
+                                       model_params=model_params)
+            response = {'joke_id': joke_id, 'joke_text': joke_text}
+            # Keep the encoded object open so the rating count can be appended
+            self.responses[joke_id] = json.dumps(response)[:-1]
+            if model_params:
+                self.cluster_ids[joke_id] = json.loads(model_params)['cluster id']
+        self.sampler = JokeSampler(self.jokes.keys(), old_jokes)
+
+    @classmethod
+    def load(cls, old_jokes):
+        """
+        Loads all the jokes from the db into a new catalog.
+        """
+        jokes = Joke.objects.values_list('id', 'joke_text', 'model_params')
+        return cls(list(jokes), old_jokes)
+
+    def get(self, joke_id):
+        """
+        :return: The joke with the specified id.
+        :raise Joke.DoesNotExist: If there is no such joke.
+        """
+        try:
+            return self.jokes[int(joke_id)]
+        except KeyError:
+            raise Joke.DoesNotExist('Joke {0} does not exist'.format(joke_id))
+
+    def cluster_id(self, joke_id):
+        """
+        :return: The index of the joke cluster of a joke, which is the value
+            of Joke.cluster_id, or None if the joke has not been assigned to
+            a joke cluster (e.g it was added after the model was built).
+        """
+        if joke_id >= len(self.cluster_ids) or self.cluster_ids[joke_id] < 0:
+            return None
+        return int(self.cluster_ids[joke_id])
+
+    def response(self, joke_id, num_jokes_rated):
+        """
+        :return: The JSON formatted request_joke response for a joke.
+        """
+        return '{0}, "num_jokes_rated": {1}}}'.format(self.responses[joke_id],
+                                                      int(num_jokes_rated))
+
+
+def invalidate_joke_catalog():
+    """
+    Causes every process to reload its catalog the next time it is used.
+    Must be called after jokes are imported or modified.
+    """
+    CacheVersion.invalidate(JOKE_CATALOG)
+
+
+_lock = threading.Lock()
+_catalog = None
+_version = None
+
+
+def get_joke_catalog(old_jokes):
+    """
+    :param old_jokes: The number of old jokes, see JokeSampler.
+    :return: The joke catalog of this process. The catalog is loaded the
+        first time it is needed and reloaded after it has been invalidated,
+        which costs a single row lookup per call.
+    """
+    global _catalog, _version
+    current = CacheVersion.current(JOKE_CATALOG)
+    with _lock:
+        if _catalog is None or _version != current:
+            _catalog, _version = JokeCatalog.load(old_jokes), current
+        return _catalog
+
+
+@receiver(post_save, sender=Joke)
+@receiver(post_delete, sender=Joke)
+def joke_changed(sender, raw=False, **kwargs):
+    """
+    Invalidates the catalogs when a joke is saved or deleted. The catalog
+    holds every field of Joke, so any save may change it. Jokes are only
+    written by the admin and the maintenance scripts, never while serving
+    requests, so changing the catalog version on each save is cheap. Fixtures
+    (raw saves) are skipped; bulk imports and updates do not send signals
+    and call invalidate_joke_catalog once themselves.
+    """
+    if not raw:
+        invalidate_joke_catalog()
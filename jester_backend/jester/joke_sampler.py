@@ -0,0 +1,50 @@
+import numpy as np
+
+
+__author__ = 'Viraj Mahesh'
+
+
+# Number of random draws before falling back to listing the unrated jokes
+MAX_ATTEMPTS = 16
+
+
+class JokeSampler(object):
+    """
+    Draws uniformly random unrated jokes from an in-memory copy of the joke
+    ids and of the new joke ids. Whether a joke has been rated is read from
+    the rated joke bitset of the user's RaterState, so sampling needs no db
+    queries.
+    """
+    def __init__(self, joke_ids, old_jokes):
+        """
+        :param joke_ids: The ids of all jokes.
+        :param old_jokes: The number of old jokes. Jokes with a larger id are
+            new jokes.
+        """
+        self.jokes = np.sort(np.asarray(joke_ids, dtype=np.int64))
+        self.new_jokes = self.jokes[self.jokes > old_jokes]
+
+    def sample(self, rng, model, new=False):
+        """
+        Draws a random joke that has not been rated by the user. Random jokes
+        are drawn until an unrated one is found, which takes O(1) expected
+        draws unless the user has rated almost all the jokes. In that case
+        the unrated jokes are listed from the bitset instead.
+
+        :param rng: The random number generator.
+        :param model: The RaterState of the user.
+        :param new: If True, only new jokes are considered.
+        :return: The id of the joke, or None if all jokes have been rated.
+        """
+        jokes = self.new_jokes if new else self.jokes
+        if len(jokes) == 0:
+            return None
+        for _ in range(MAX_ATTEMPTS):
+            joke_id = int(jokes[int(rng.random() * len(jokes))])
+            if not model.has_rated(joke_id):
+                return joke_id
+        unrated = jokes[~model.rated_mask(jokes)]
+        if len(unrated) == 0:
+            return None
+        return int(unrated[int(rng.random() * len(unrated))])
+
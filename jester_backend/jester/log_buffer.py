@@ -0,0 +1,121 @@
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from django.db import connection
+
+
+__author__ = 'Viraj Mahesh'
+
+
+logger = logging.getLogger(__name__)
+
+
+class LogBuffer(object):
+    """
+    Write-behind buffer for log rows (i.e UserLog and RecommenderLog
+    instances). Rows are queued in memory and inserted with one bulk_create
+    per model by a background thread, once the buffer holds max_size rows or
+    every flush_interval seconds. Rows are never inserted on the thread that
+    queues them, so logging does not query the db within a request (or
+    within its transaction). The buffer is also flushed when the process
+    exits.
+    """
+    def __init__(self, max_size, flush_interval):
+        """
+        :param max_size: The number of buffered rows that triggers a flush.
+        :param flush_interval: The maximum number of seconds between flushes.
+        """
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.entries = []
+        # Set when the buffer is full, to wake up the background thread
+        self.full = threading.Event()
+        self.closed = False
+        self.thread = None
+
+    def add(self, entry):
+        """
+        Queues an unsaved model instance to be inserted in the db.
+        """
+        with self.lock:
+            self.entries.append(entry)
+            if len(self.entries) >= self.max_size:
+                self.full.set()
+            # The thread is restarted if it died, so the buffer never grows
+            # without being flushed
+            if not self.closed and (self.thread is None or
+                                    not self.thread.is_alive()):
+                self.start()
+
+    def flush(self):
+        """
+        Inserts all buffered rows in the db, using one query per model.
+        """
+        with self.lock:
+            entries, self.entries = self.entries, []
+            self.full.clear()
+        batches = OrderedDict()
+        for entry in entries:
+            batches.setdefault(type(entry), []).append(entry)
+        for model, batch in batches.items():
+            try:
+                model.objects.bulk_create(batch)
+            except Exception:
+                logger.exception('Dropped %d %s rows', len(batch),
+                                 model.__name__)
+
+    def start(self):
+        """
+        Starts the background thread that flushes the buffer.
+        """
+        self.thread = threading.Thread(target=self.run, name='log-buffer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        """
+        Stops the background thread and flushes the buffer. Called when the
+        process exits, before daemon threads are torn down.
+        """
+        with self.lock:
+            self.closed = True
+            thread = self.thread
+        self.full.set()
+        if thread is not None:
+            thread.join()
+        self.flush()
+
+    def run(self):
+        while not self.closed:
+            self.full.wait(self.flush_interval)
+            with self.lock:
+                pending = bool(self.entries)
+            if not pending:
+                continue
+            try:
+                self.flush()
+                # The connection belongs to this thread, which is never
+                # part of a request, so it is not closed by Django
+                connection.close()
+            except Exception:
+                # Keep flushing, a failed flush only drops its own rows
+                logger.exception('Failed to flush the log buffer')
+
+
+log_buffer = LogBuffer(settings.LOG_BUFFER_SIZE, settings.LOG_FLUSH_INTERVAL)
+atexit.register(log_buffer.close)
+
+
+def sampled(user):
+    """
+    Decides whether the recommender decisions for a user are logged. Users are
+    sampled deterministically, so the traces of a sampled user are complete.
+
+    :return: True for a fraction RECOMMENDER_LOG_SAMPLE_RATE of the users.
+    """
+    # Knuth's multiplicative hash spreads consecutive ids over [0, 1)
+    return (user.id * 2654435761 % 2 ** 32) / 2.0 ** 32 < \
+        settings.RECOMMENDER_LOG_SAMPLE_RATE
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jester', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recommendermodel',
+            name='path',
+            field=models.CharField(default=b'', max_length=255, verbose_name=b'path', blank=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import json
+import numpy as np
+import struct
+
+# The version 1 format of jester.rater_state.RaterState, copied so that this
+# migration does not change with the live format: a header (format version,
+# number of joke clusters k, moving average vector size w, user cluster id),
+# k x w float32 moving averages, k uint16 counts of jokes rated, k uint8 ring
+# buffer positions and a bitset of the rated joke ids.
+VERSION = 1
+HEADER = struct.Struct('<BBBxi')
+
+
+def pack_state(model):
+    """
+    :param model: The JSON formatted model of a rater.
+    :return: The model packed in the version 1 format.
+    """
+    moving_averages = np.asarray(model['moving averages'], dtype=np.float32)
+    k, w = moving_averages.shape
+    rated = bytearray(max(model['rated ids']) // 8 + 1 if model['rated ids']
+                      else 0)
+    for joke_id in model['rated ids']:
+        rated[joke_id // 8] |= 1 << joke_id % 8
+    return (HEADER.pack(VERSION, k, w, int(model['user cluster id'])) +
+            moving_averages.tobytes() +
+            np.asarray(model['jokes rated'], dtype=np.uint16).tobytes() +
+            np.zeros(k, dtype=np.uint8).tobytes() + bytes(rated))
+
+
+def unpack_state(data):
+    """
+    :param data: A state packed in the version 1 format.
+    :return: The JSON formatted model of the rater.
+    """
+    data = bytes(data)
+    version, k, w, user_cluster_id = HEADER.unpack(data[:HEADER.size])
+    if version != VERSION:
+        raise ValueError('Unsupported rater state version {0}'.format(version))
+    offset = HEADER.size
+    moving_averages = np.frombuffer(data, np.float32, k * w, offset).reshape(k, w)
+    offset += moving_averages.nbytes
+    jokes_rated = np.frombuffer(data, np.uint16, k, offset)
+    offset += jokes_rated.nbytes
+    positions = np.frombuffer(data, np.uint8, k, offset)
+    offset += positions.nbytes
+    rated = bytearray(data[offset:])
+    return {'user cluster id': user_cluster_id,
+            'moving averages': [np.roll(ratings, -position).tolist() for
+                                ratings, position in zip(moving_averages,
+                                                         positions)],
+            'jokes rated': jokes_rated.tolist(),
+            'rated ids': [joke_id for joke_id in range(len(rated) * 8)
+                          if rated[joke_id // 8] & (1 << joke_id % 8)]}
+
+
+def pack_model_params(apps, schema_editor):
+    """
+    Converts the JSON formatted model parameters of each rater into a packed
+    state.
+    """
+    Rater = apps.get_model('jester', 'Rater')
+    for rater in Rater.objects.exclude(model_params='').iterator():
+        rater.state = pack_state(json.loads(rater.model_params))
+        rater.save(update_fields=['state'])
+
+
+def unpack_model_params(apps, schema_editor):
+    Rater = apps.get_model('jester', 'Rater')
+    for rater in Rater.objects.exclude(state=None).iterator():
+        rater.model_params = json.dumps(unpack_state(rater.state))
+        rater.save(update_fields=['model_params'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jester', '0002_recommendermodel_path'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rater',
+            name='state',
+            field=models.BinaryField(null=True, verbose_name=b'state'),
+            preserve_default=True,
+        ),
+        migrations.RunPython(pack_model_params, unpack_model_params),
+        migrations.RemoveField(
+            model_name='rater',
+            name='model_params',
+        ),
+    ]
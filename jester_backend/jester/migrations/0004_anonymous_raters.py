@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jester', '0003_rater_state'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='rater',
+            name='user',
+            field=models.OneToOneField(null=True, blank=True, to=settings.AUTH_USER_MODEL),
+            preserve_default=True,
+        ),
+    ]
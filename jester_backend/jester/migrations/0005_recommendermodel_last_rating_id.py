@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jester', '0004_anonymous_raters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recommendermodel',
+            name='last_rating_id',
+            field=models.IntegerField(null=True, verbose_name=b'last rating id', blank=True),
+            preserve_default=True,
+        ),
+    ]
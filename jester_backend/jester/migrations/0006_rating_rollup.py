@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jester', '0005_recommendermodel_last_rating_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Checkpoint',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(unique=True, max_length=64, verbose_name=b'name')),
+                ('last_id', models.IntegerField(default=0, verbose_name=b'last id')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='RatingRollup',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('date', models.DateField(verbose_name=b'date')),
+                ('rating_type', models.IntegerField(default=1)),
+                ('bin', models.SmallIntegerField(verbose_name=b'bin')),
+                ('count', models.IntegerField(default=0, verbose_name=b'count')),
+                ('total', models.FloatField(default=0, verbose_name=b'total')),
+                ('zeros', models.IntegerField(default=0, verbose_name=b'zeros')),
+                ('joke', models.ForeignKey(to='jester.Joke')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='ratingrollup',
+            unique_together=set([('date', 'joke', 'rating_type', 'bin')]),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jester', '0006_rating_rollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JokeStats',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('count', models.IntegerField(default=0, verbose_name=b'count')),
+                ('total', models.FloatField(default=0, verbose_name=b'total')),
+                ('squares', models.FloatField(default=0, verbose_name=b'squares')),
+                ('joke', models.OneToOneField(to='jester.Joke')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
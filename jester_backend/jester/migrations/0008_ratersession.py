@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jester', '0007_jokestats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RaterSession',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('start', models.DateTimeField(verbose_name=b'start')),
+                ('end', models.DateTimeField(verbose_name=b'end')),
+                ('actions', models.IntegerField(default=0, verbose_name=b'actions')),
+                ('ratings', models.IntegerField(default=0, verbose_name=b'ratings')),
+                ('user', models.ForeignKey(to='jester.Rater')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterIndexTogether(
+            name='ratersession',
+            index_together=set([('user', 'end')]),
+        ),
+    ]
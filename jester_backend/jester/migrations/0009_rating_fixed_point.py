@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.db.models import F
+
+# Ratings are stored in units of 1 / RATING_SCALE
+RATING_SCALE = 10000
+
+
+def scale_ratings(apps, schema_editor):
+    Rating = apps.get_model('jester', 'Rating')
+    Rating.objects.update(rating=F('rating') * RATING_SCALE)
+
+
+def unscale_ratings(apps, schema_editor):
+    Rating = apps.get_model('jester', 'Rating')
+    # Divide by a float, integer division would truncate the ratings
+    Rating.objects.update(rating=F('rating') / float(RATING_SCALE))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jester', '0008_ratersession'),
+    ]
+
+    operations = [
+        # Widen the column so that it can hold the scaled ratings
+        migrations.AlterField(
+            model_name='rating',
+            name='rating',
+            field=models.DecimalField(verbose_name=b'rating', max_digits=10, decimal_places=4),
+            preserve_default=True,
+        ),
+        migrations.RunPython(scale_ratings, unscale_ratings),
+        migrations.AlterField(
+            model_name='rating',
+            name='rating',
+            field=models.IntegerField(verbose_name=b'rating'),
+            preserve_default=True,
+        ),
+    ]
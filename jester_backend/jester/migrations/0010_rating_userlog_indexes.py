@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jester', '0009_rating_fixed_point'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='rating',
+            index_together=set([('user', 'joke'), ('timestamp', 'rating')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='userlog',
+            index_together=set([('user', 'timestamp')]),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jester', '0010_rating_userlog_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='checkpoint',
+            name='gaps',
+            field=models.TextField(default=b'[]', verbose_name=b'gaps'),
+            preserve_default=True,
+        ),
+    ]
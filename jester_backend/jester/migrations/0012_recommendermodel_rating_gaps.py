@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jester', '0011_checkpoint_gaps'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recommendermodel',
+            name='rating_gaps',
+            field=models.TextField(default=b'[]', verbose_name=b'rating gaps'),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jester', '0012_recommendermodel_rating_gaps'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailingListMember',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('timestamp', models.DateTimeField(verbose_name=b'time stamp')),
+                ('email', models.TextField(verbose_name=b'email')),
+                ('reference', models.TextField(verbose_name=b'reference')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jester', '0013_mailinglistmember'),
+    ]
+
+    # The user columns are the first columns of the (user, joke) and
+    # (user, timestamp) indexes, which serve the lookups by user
+    operations = [
+        migrations.AlterField(
+            model_name='rating',
+            name='user',
+            field=models.ForeignKey(to='jester.Rater', db_index=False),
+            preserve_default=True,
+        ),
+        migrations.AlterField(
+            model_name='userlog',
+            name='user',
+            field=models.ForeignKey(to='jester.Rater', db_index=False),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jester', '0014_drop_user_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recommendermodel',
+            name='pending_raters',
+            field=models.TextField(default=b'[]', verbose_name=b'pending raters'),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+# The version of the data_visualization responses is now a CacheVersion
+DATA_VISUALIZATION = 'data visualization'
+
+
+def remove_checkpoint(apps, schema_editor):
+    Checkpoint = apps.get_model('jester', 'Checkpoint')
+    Checkpoint.objects.filter(name=DATA_VISUALIZATION).delete()
+
+
+def restore_checkpoint(apps, schema_editor):
+    # The checkpoint is recreated when the responses are next invalidated
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jester', '0016_cacheversion'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_checkpoint, restore_checkpoint),
+    ]
@@ -3,7 +3,24 @@ from django.db import models
 from django.utils import timezone
 from ipware.ip import get_ip
 from django_enumfield import enum
+from itertools import islice
+from jester.log_buffer import log_buffer, sampled
+from jester.rater_state import RaterState
 import json
+import numpy as np
+import uuid
+
+
+# Ratings are stored as integers, in units of 1 / RATING_SCALE
+RATING_SCALE = 10000
+
+
+def to_fixed_point(rating):
+    """
+    :return: The stored value of a rating, i.e the rating in units of
+        1 / RATING_SCALE.
+    """
+    return int(round(rating * RATING_SCALE))
 
 
 class Joke(models.Model):
@@ -50,17 +67,18 @@ class Rater(models.Model):
     """
     Represents a User that has clicked the 'Begin' button and can submit ratings
 
-    :param model_params: JSON formatted object with the following fields:
-        {
-
-        }
+    :param user: The auth_user entry of the user. Only set for users created
+        before anonymous raters were introduced; new raters are identified by
+        their id, which is stored in their session.
+    :param state: The Eigentaste state of the user, packed by RaterState. Empty
+        until the user has rated the gauge set.
     :param jokes_rated: The number of jokes rated by the user.
     :param last_requested_joke: The last joke that was requested by the user.
     :param stale: Identifies whether the user has already rated the last
         requested joke.
     """
-    user = models.OneToOneField(User)
-    model_params = models.TextField('model parameters', default='')
+    user = models.OneToOneField(User, null=True, blank=True)
+    state = models.BinaryField('state', null=True)
     jokes_rated = models.IntegerField('jokes rated', default=0)
     last_requested_joke = models.ForeignKey(Joke, default=None, null=True)
     last_requested_joke_type = enum.EnumField(RatingType)
@@ -75,11 +93,17 @@ class Rater(models.Model):
         self.save()
 
     def store_model_and_save(self, model):
-        self.model_params = json.dumps(model)
-        self.save()
+        """
+        Packs the RaterState of the user and saves it.
+        """
+        self.state = model.pack()
+        self.save(update_fields=['state'])
 
     def load_model(self):
-        return json.loads(self.model_params)
+        """
+        :return: The RaterState of the user.
+        """
+        return RaterState(self.state)
 
     def requested_new_joke(self, joke, random, gauge):
         if gauge:
@@ -103,6 +127,37 @@ class Rater(models.Model):
         return '(id={0}, jokes_rated={1})'.format(self.id, self.jokes_rated)
 
 
+class RatingQuerySet(models.QuerySet):
+    """
+    QuerySet of ratings, with bulk reads into numpy arrays.
+    """
+    def as_arrays(self, chunk_size=100000):
+        """
+        Streams the ratings of the queryset into numpy arrays, fetching only
+        the user id, joke id and rating columns, without creating model
+        instances.
+
+        :param chunk_size: The number of rows converted to arrays at a time.
+        :return: A tuple of arrays (user ids, joke ids, ratings), where the
+            ratings are floats between -10 and 10.
+        """
+        rows = self.values_list('user_id', 'joke_id', 'rating').iterator()
+        users, jokes, ratings = [], [], []
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            user_ids, joke_ids, values = zip(*chunk)
+            users.append(np.array(user_ids, dtype=np.int64))
+            jokes.append(np.array(joke_ids, dtype=np.int64))
+            ratings.append(np.array(values, dtype=np.int32))
+        if not users:
+            return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64),
+                    np.empty(0, dtype=np.float64))
+        return (np.concatenate(users), np.concatenate(jokes),
+                np.concatenate(ratings) / float(RATING_SCALE))
+
+
 class Rating(models.Model):
     """
     Represents a rating submitted by the user
@@ -114,29 +169,44 @@ class Rating(models.Model):
     :param joke_rating_idx: The index of this joke in the sequence of presented jokes.
         If the information is missing, this field will be 0.
     :param rating: The rating of the specified joke by the user, which is a
-        decimal value from -10 to 10.
+        decimal value from -10 to 10 with 4 decimal places. It is stored in
+        units of 1 / RATING_SCALE, use to_float to read it.
     :param timestamp: The time at which this rating was made.
     :param rating_type: Distinguishes between random, recommended and gauge set ratings
     """
-    user = models.ForeignKey(Rater)
+    # Lookups by user are served by the (user, joke) index
+    user = models.ForeignKey(Rater, db_index=False)
     joke = models.ForeignKey(Joke)
-    rating = models.DecimalField('rating', decimal_places=4, max_digits=6)
+    rating = models.IntegerField('rating')
     timestamp = models.DateTimeField('time stamp', blank=True, null=True)
     rating_type = enum.EnumField(RatingType)
 
+    objects = RatingQuerySet.as_manager()
+
+    class Meta:
+        # (timestamp, rating) covers date range queries that only read the
+        # ratings
+        index_together = [['user', 'joke'], ['timestamp', 'rating']]
+
     def to_float(self):
-        return float(self.rating)
+        return self.rating / float(RATING_SCALE)
 
     def date(self):
         return self.timestamp.date()
 
     @staticmethod
-    def create(user, joke, rating):
+    def create(user, joke, rating, rating_type=None):
+        """
+        :param rating_type: The type of the rating, by default the type of
+            the last joke requested by the user.
+        """
+        if rating_type is None:
+            rating_type = user.last_requested_joke_type
         return Rating(user=user,
                       joke=joke,
-                      rating=rating,
+                      rating=to_fixed_point(rating),
                       timestamp=timezone.now(),
-                      rating_type=user.last_requested_joke_type)
+                      rating_type=rating_type)
 
     def __unicode__(self):
         """
@@ -144,17 +214,144 @@ class Rating(models.Model):
         """
         return '(user_id={0}, joke_id={1}, joke_idx={2}, rating={3}, timestamp={4})'. \
             format(self.user.id, self.joke.id,
-                   self.joke_rating_idx, self.rating, self.timestamp)
+                   self.joke_rating_idx, self.to_float(), self.timestamp)
+
+
+class RatingRollup(models.Model):
+    """
+    Daily summary of the ratings of a joke, from which ratings analytics are
+    answered without reading every rating. Ratings are grouped by day, joke,
+    rating type and histogram bin (see jester.rollups). Maintained by
+    jester.rollups.compact_ratings.
+
+    :param: date: The day on which the ratings were made (in UTC).
+    :param: joke: The joke that was rated.
+    :param: rating_type: The type of the ratings.
+    :param: bin: The index of the histogram bin of the ratings.
+    :param: count: The number of ratings.
+    :param: total: The sum of the ratings.
+    :param: zeros: The number of ratings equal to 0.
+    """
+    date = models.DateField('date')
+    joke = models.ForeignKey(Joke)
+    rating_type = enum.EnumField(RatingType)
+    bin = models.SmallIntegerField('bin')
+    count = models.IntegerField('count', default=0)
+    total = models.FloatField('total', default=0)
+    zeros = models.IntegerField('zeros', default=0)
+
+    class Meta:
+        unique_together = ('date', 'joke', 'rating_type', 'bin')
+
+
+class JokeStats(models.Model):
+    """
+    Running statistics of the ratings of a joke, from which the mean and the
+    variance of its ratings are computed. Maintained by
+    jester.rollups.compact_ratings.
+
+    :param: joke: The joke.
+    :param: count: The number of ratings.
+    :param: total: The sum of the ratings.
+    :param: squares: The sum of the squares of the ratings.
+    """
+    joke = models.OneToOneField(Joke)
+    count = models.IntegerField('count', default=0)
+    total = models.FloatField('total', default=0)
+    squares = models.FloatField('squares', default=0)
+
+
+class Checkpoint(models.Model):
+    """
+    Records how far a periodic job has read a table, so that each run only
+    reads the rows added since the previous run.
+
+    Ids are allocated when rows are inserted, not when they are committed,
+    so a row may become visible after rows with larger ids have been
+    processed. The ids below last_id that were missing when they were
+    passed are therefore kept in gaps, and read again by the next runs
+    (see jester.rollups.process_new_rows).
+
+    :param: name: The name of the job.
+    :param: last_id: The id of the last row processed by the job.
+    :param: gaps: A JSON formatted list of [first id, last id, time] ranges
+        of missing ids below last_id, where time is when the range was
+        found.
+    """
+    name = models.CharField('name', max_length=64, unique=True)
+    last_id = models.IntegerField('last id', default=0)
+    gaps = models.TextField('gaps', default='[]')
+
+
+class CacheVersion(models.Model):
+    """
+    The version of data that every process keeps a copy of, such as the
+    joke catalog. A process reloads its copy when the version changes,
+    which is checked with a single row lookup. Versions are random, so that
+    a version is never reused, even by a transaction that is rolled back.
+
+    :param: name: The name of the data.
+    :param: version: The current version of the data.
+    """
+    name = models.CharField('name', max_length=255, unique=True)
+    version = models.CharField('version', max_length=32)
+
+    @staticmethod
+    def current(name):
+        """
+        :return: The current version of the data, or '' if it has never been
+            invalidated.
+        """
+        version = CacheVersion.objects.filter(name=name). \
+            values_list('version', flat=True)
+        return version[0] if version else ''
+
+    @staticmethod
+    def invalidate(name):
+        """
+        Gives the data a new version, so that every process reloads it.
+        """
+        version = uuid.uuid4().hex
+        if not CacheVersion.objects.filter(name=name).update(version=version):
+            CacheVersion.objects.get_or_create(name=name,
+                                               defaults={'version': version})
 
 
 class RecommenderModel(models.Model):
     """
-    Stores a JSON formatted python object, that represent the recommender model.
+    Stores the recommender model. The model is either stored as a JSON
+    formatted python object in data, or in the binary format in the
+    directory specified by path, in which case data is empty.
+
+    :param: last_rating_id: The id of the last rating included in the model.
+        Ratings with a larger id can be folded into the model without
+        retraining it, see scripts.utilities.refresh_model.
+    :param: rating_gaps: The ranges of ids below last_rating_id that were
+        missing when the model was refreshed, and whose ratings are folded
+        by the next refresh if they appear. See Checkpoint.gaps.
+    :param: pending_raters: The raters that had not been assigned to a user
+        cluster when the model was refreshed, as [rater id, rating id] pairs.
+        Their ratings from that rating id up to last_rating_id are not in
+        the model yet, and are folded by the first refresh after the rater
+        is assigned to a cluster.
     """
     data = models.TextField(default='')
+    path = models.CharField('path', max_length=255, blank=True, default='')
+    last_rating_id = models.IntegerField('last rating id', null=True,
+                                         blank=True)
+    rating_gaps = models.TextField('rating gaps', default='[]')
+    pending_raters = models.TextField('pending raters', default='[]')
 
-    def store(self, model):
-        self.data = json.dumps(model.export_model())
+    def store(self, model, path=None):
+        """
+        Stores a model. If path is given, the model is saved in the binary
+        format in that directory, otherwise it is stored as JSON.
+        """
+        if path is None:
+            self.data = json.dumps(model.export_model())
+        else:
+            model.save(path)
+            self.data, self.path = '', path
 
 
 class UserActionType(enum.Enum):
@@ -176,7 +373,8 @@ class UserActionType(enum.Enum):
 
 class UserLog(models.Model):
     """
-    Represents an action executed by the user
+    Represents an action executed by the user. Actions are logged through the
+    write-behind log buffer, so they are inserted shortly after they happen.
 
     :param: timestamp: Records the time the action took place.
     :param: ip_address: The IP Address of the user.
@@ -189,21 +387,32 @@ class UserLog(models.Model):
     ip_address = models.IPAddressField('ip address', null=True)
     action = models.TextField('action')
     action_type = enum.EnumField(UserActionType)
-    user = models.ForeignKey(Rater)
+    # Lookups by user are served by the (user, timestamp) index
+    user = models.ForeignKey(Rater, db_index=False)
     params = models.TextField('params', default='', null=True)
 
+    class Meta:
+        index_together = [['user', 'timestamp']]
+
     @staticmethod
-    def log_rating(request, user, joke, rating):
+    def rating_log(request, user, joke, rating):
+        """
+        :return: An unsaved UserLog recording a rating. The rating id in the
+            params is null if the rating was inserted in bulk.
+        """
         action = ('User {0} submitted rating of {1} for joke {2}'.
                   format(user.id, rating.to_float(), joke.id))
         params = {'user_id': user.id, 'joke_id': joke.id, 'rating': rating.id}
-        user_action = UserLog(timestamp=timezone.now(),
-                              ip_address=get_ip(request),
-                              action=action,
-                              action_type=UserActionType.RATING,
-                              user=user,
-                              params=json.dumps(params))
-        user_action.save()
+        return UserLog(timestamp=timezone.now(),
+                       ip_address=get_ip(request),
+                       action=action,
+                       action_type=UserActionType.RATING,
+                       user=user,
+                       params=json.dumps(params))
+
+    @staticmethod
+    def log_rating(request, user, joke, rating):
+        log_buffer.add(UserLog.rating_log(request, user, joke, rating))
 
     @staticmethod
     def log_logout(request, user):
@@ -214,7 +423,7 @@ class UserLog(models.Model):
                               action_type=UserActionType.LOGOUT,
                               user=user,
                               params='')
-        user_action.save()
+        log_buffer.add(user_action)
 
     @staticmethod
     def log_slider(request, user, old_rating, new_rating):
@@ -227,7 +436,7 @@ class UserLog(models.Model):
                               action_type=UserActionType.SLIDER,
                               user=user,
                               params=json.dumps(params))
-        user_action.save()
+        log_buffer.add(user_action)
 
     @staticmethod
     def log_request_joke(request, user, joke, stale, random, gauge):
@@ -246,12 +455,42 @@ class UserLog(models.Model):
                               action=action,
                               action_type=UserActionType.REQUEST_JOKE,
                               user=user)
-        user_action.save()
+        log_buffer.add(user_action)
+
+
+class RaterSession(models.Model):
+    """
+    A session of a rater, i.e a sequence of actions without a break longer
+    than jester.rollups.SESSION_TIMEOUT. Built from the UserLog table by
+    jester.rollups.compact_user_logs.
+
+    :param: user: The rater.
+    :param: start: The time of the first action of the session.
+    :param: end: The time of the last action of the session.
+    :param: actions: The number of actions in the session.
+    :param: ratings: The number of ratings submitted in the session.
+    """
+    user = models.ForeignKey(Rater)
+    start = models.DateTimeField('start')
+    end = models.DateTimeField('end')
+    actions = models.IntegerField('actions', default=0)
+    ratings = models.IntegerField('ratings', default=0)
+
+    class Meta:
+        index_together = [['user', 'end']]
+
+    def duration(self):
+        """
+        :return: The duration of the session in seconds.
+        """
+        return (self.end - self.start).total_seconds()
 
 
 class RecommenderLog(models.Model):
     """
-    Represents an action executed by the recommender system.
+    Represents an action executed by the recommender system. Actions are
+    logged through the write-behind log buffer, and only for the fraction of
+    users set by RECOMMENDER_LOG_SAMPLE_RATE.
 
     :param: timestamp: Records the time the action took place.
     """
@@ -261,30 +500,36 @@ class RecommenderLog(models.Model):
 
     @staticmethod
     def log_cluster_choice(user, item_cluster_idx, average):
+        if not sampled(user):
+            return
         action = ('Selected cluster {0} with average {1} for User {2}'.
                   format(item_cluster_idx, average, user.id))
         recommender_action = RecommenderLog(timestamp=timezone.now(),
                                             action=action,
                                             user=user)
-        recommender_action.save()
+        log_buffer.add(recommender_action)
 
     @staticmethod
     def log_averages(user, averages):
+        if not sampled(user):
+            return
         averages = ['{:0.2f}'.format(mean) for _, mean in averages]
         action = 'Averages: {0}'.format(averages)
         recommender_action = RecommenderLog(timestamp=timezone.now(),
                                             action=action,
                                             user=user)
-        recommender_action.save()
+        log_buffer.add(recommender_action)
 
     @staticmethod
     def log_prediction(user, joke, prediction):
+        if not sampled(user):
+            return
         action = ('Predicted a rating of {0:.2f} for User {1} for Joke {2}'.
                   format(prediction, user.id, joke.id))
         recommender_action = RecommenderLog(timestamp=timezone.now(),
                                             action=action,
                                             user=user)
-        recommender_action.save()
+        log_buffer.add(recommender_action)
 
 
 class MailingListMember(models.Model):
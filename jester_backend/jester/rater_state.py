@@ -0,0 +1,151 @@
+import numpy as np
+import struct
+
+
+__author__ = 'Viraj Mahesh'
+
+
+class RaterState(object):
+    """
+    The Eigentaste state of a rater, stored in a compact binary format. The
+    state is made up of a fixed size part followed by a bitset of rated jokes:
+
+        header: format version, number of joke clusters (k), moving average
+            vector size (w) and the id of the user cluster of the rater.
+        moving averages: k x w float32 ring buffers holding the last w
+            ratings of the rater in each joke cluster.
+        jokes rated: k uint16 counts of jokes rated in each joke cluster.
+        positions: k uint8 indices of the oldest rating in each ring buffer.
+        rated ids: bitset where bit i is set if joke i has been rated.
+
+    The arrays are views into the packed buffer, so loading, updating and
+    packing the state does not depend on the number of jokes rated.
+    """
+    VERSION = 1
+    HEADER = struct.Struct('<BBBxi')
+
+    def __init__(self, data):
+        """
+        Loads a packed state.
+
+        :param data: The packed state, as returned by pack().
+        """
+        header = bytes(data[:self.HEADER.size])
+        version, k, w, self.user_cluster_id = self.HEADER.unpack(header)
+        if version != self.VERSION:
+            raise ValueError('Unsupported rater state version {0}'.format(version))
+        size = self.fixed_size(k, w)
+        self.data = bytearray(data[:size])
+        offset = self.HEADER.size
+        self.moving_averages = np.frombuffer(self.data, np.float32, k * w,
+                                             offset).reshape(k, w)
+        offset += self.moving_averages.nbytes
+        self.jokes_rated = np.frombuffer(self.data, np.uint16, k, offset)
+        offset += self.jokes_rated.nbytes
+        self.positions = np.frombuffer(self.data, np.uint8, k, offset)
+        self.rated = bytearray(data[size:])
+
+    @classmethod
+    def fixed_size(cls, k, w):
+        """
+        :return: The size in bytes of the fixed size part of the state.
+        """
+        return cls.HEADER.size + k * w * 4 + k * 2 + k
+
+    @classmethod
+    def create(cls, user_cluster_id, moving_averages):
+        """
+        Creates the state of a rater that has just been assigned to a cluster.
+
+        :param user_cluster_id: The id of the user cluster of the rater.
+        :param moving_averages: A list of k lists, each containing the w
+            initial values of the moving average of a joke cluster.
+        """
+        moving_averages = np.asarray(moving_averages, dtype=np.float32)
+        k, w = moving_averages.shape
+        data = bytearray(cls.fixed_size(k, w))
+        cls.HEADER.pack_into(data, 0, cls.VERSION, k, w, int(user_cluster_id))
+        data[cls.HEADER.size:cls.HEADER.size + moving_averages.nbytes] = \
+            moving_averages.tobytes()
+        return cls(data)
+
+    @classmethod
+    def import_model(cls, model):
+        """
+        Creates a state from the JSON formatted model previously stored in
+        Rater.model_params.
+        """
+        state = cls.create(model['user cluster id'], model['moving averages'])
+        state.jokes_rated[:] = model['jokes rated']
+        for joke_id in model['rated ids']:
+            state.mark_rated(joke_id)
+        return state
+
+    def export_model(self):
+        """
+        :return: The state in the JSON formatted model previously stored in
+            Rater.model_params.
+        """
+        moving_averages = [np.roll(ratings, -position).tolist() for ratings,
+                           position in zip(self.moving_averages, self.positions)]
+        exported_model = {'user cluster id': int(self.user_cluster_id),
+                          'moving averages': moving_averages,
+                          'jokes rated': self.jokes_rated.tolist(),
+                          'rated ids': self.rated_ids()}
+        return exported_model
+
+    def pack(self):
+        """
+        :return: The state packed into a string of bytes.
+        """
+        self.HEADER.pack_into(self.data, 0, self.VERSION,
+                              self.moving_averages.shape[0],
+                              self.moving_averages.shape[1],
+                              self.user_cluster_id)
+        return bytes(self.data + self.rated)
+
+    def rate(self, cluster_idx, rating):
+        """
+        Records a rating for a joke in a joke cluster, replacing the oldest
+        rating in the moving average of that cluster.
+        """
+        position = self.positions[cluster_idx]
+        self.moving_averages[cluster_idx, position] = rating
+        self.positions[cluster_idx] = (position + 1) % self.moving_averages.shape[1]
+        self.jokes_rated[cluster_idx] += 1
+
+    def mark_rated(self, joke_id):
+        """
+        Marks a joke as rated. The bitset only grows when a joke id larger
+        than any previously rated one is marked.
+        """
+        byte, bit = divmod(joke_id, 8)
+        if byte >= len(self.rated):
+            self.rated.extend(bytearray(byte + 1 - len(self.rated)))
+        self.rated[byte] |= 1 << bit
+
+    def has_rated(self, joke_id):
+        byte, bit = divmod(joke_id, 8)
+        return byte < len(self.rated) and bool(self.rated[byte] & (1 << bit))
+
+    def rated_mask(self, joke_ids):
+        """
+        :param joke_ids: An array of joke ids.
+        :return: A boolean array that is True for the jokes that were rated.
+        """
+        joke_ids = np.asarray(joke_ids)
+        rated = np.frombuffer(bytes(self.rated), np.uint8)
+        byte, bit = joke_ids // 8, joke_ids % 8
+        mask = byte < len(rated)
+        mask[mask] = (rated[byte[mask]] >> bit[mask]) & 1 == 1
+        return mask
+
+    def rated_ids(self):
+        """
+        :return: A list containing the ids of all rated jokes, in ascending
+            order.
+        """
+        bits = np.unpackbits(np.frombuffer(bytes(self.rated), np.uint8))
+        # unpackbits returns the most significant bit first
+        bits = bits.reshape(-1, 8)[:, ::-1].ravel()
+        return np.nonzero(bits)[0].tolist()
@@ -0,0 +1,373 @@
+from __future__ import division
+import json
+import math
+import time
+from datetime import timedelta
+import numpy as np
+from django.db import transaction
+from django.db.models import F, Max, Q
+from jester.models import Checkpoint, JokeStats, Rating, RatingRollup, \
+    RaterSession, UserActionType, UserLog, RATING_SCALE
+
+
+__author__ = 'Viraj Mahesh'
+
+
+# Ratings are summarized in BINS bins of equal width between MIN_RATING and
+# MAX_RATING. The last bin also holds ratings equal to MAX_RATING.
+BINS = 20
+MIN_RATING, MAX_RATING = -10.0, 10.0
+BIN_WIDTH = (MAX_RATING - MIN_RATING) / BINS
+
+# Names of the checkpoints of the jobs run by compact_ratings
+RATING_ROLLUP = 'rating rollup'
+JOKE_STATISTICS = 'joke statistics'
+RATER_SESSIONS = 'rater sessions'
+
+# A rater that is inactive for longer than SESSION_TIMEOUT starts a new
+# session with its next action
+SESSION_TIMEOUT = timedelta(minutes=30)
+
+# Maximum number of ids in a single IN clause
+MAX_IN_CLAUSE = 500
+
+# Number of rows read per transaction
+BATCH_SIZE = 10000
+
+# Number of seconds during which missing ids are read again. Transactions
+# are assumed to commit within that time; ids that are still missing after
+# it were rolled back or skipped by the db.
+GAP_TIMEOUT = 3600
+
+# Maximum number of id ranges in a single query
+MAX_RANGES = 100
+
+
+def rating_bin(rating):
+    """
+    :return: The index of the histogram bin of a rating.
+    """
+    idx = int(math.floor((rating - MIN_RATING) / BIN_WIDTH))
+    return min(max(idx, 0), BINS - 1)
+
+
+def rating_bin_edges():
+    """
+    :return: The BINS + 1 edges of the histogram bins.
+    """
+    return np.linspace(MIN_RATING, MAX_RATING, BINS + 1)
+
+
+def histogram_median(hist, edges):
+    """
+    Estimates the median of a set of values from their histogram, assuming
+    that the values are spread uniformly within each bin.
+
+    :param hist: The number of values in each bin.
+    :param edges: The edges of the bins.
+    :return: The estimated median, or NaN if the histogram is empty.
+    """
+    cumulative = np.cumsum(hist)
+    if len(cumulative) == 0 or cumulative[-1] == 0:
+        return np.nan
+    half = cumulative[-1] / 2
+    idx = int(np.searchsorted(cumulative, half))
+    before = cumulative[idx - 1] if idx > 0 else 0
+    return edges[idx] + (half - before) / hist[idx] * (edges[idx + 1] - edges[idx])
+
+
+def find_gaps(ids, after, now):
+    """
+    Finds the ids missing from a sorted list of ids.
+
+    :param ids: The ids read after the id after, in ascending order.
+    :param after: The id after which the ids were read.
+    :param now: The time at which the ids were read.
+    :return: A list of [first id, last id, now] ranges of the ids between
+        after and the last of ids that are missing.
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    if len(ids) == 0:
+        return []
+    previous = np.concatenate([[after], ids[:-1]])
+    missing = ids > previous + 1
+    return [[int(first), int(last), now] for first, last in
+            zip(previous[missing] + 1, ids[missing] - 1)]
+
+
+def fill_gaps(gaps, ids, now):
+    """
+    Removes ids that have been read from ranges of missing ids, and drops the
+    ranges found more than GAP_TIMEOUT seconds ago.
+
+    :param gaps: A list of [first id, last id, time] ranges, see find_gaps.
+    :param ids: The ids read from the ranges.
+    :param now: The current time.
+    :return: The ranges of the ids that are still missing.
+    """
+    ids = np.sort(np.asarray(ids, dtype=np.int64))
+    remaining = []
+    for first, last, found in gaps:
+        if now - found > GAP_TIMEOUT:
+            continue
+        inside = ids[(ids >= first) & (ids <= last)]
+        remaining.extend(find_gaps(np.append(inside, last + 1), first - 1,
+                                   found))
+    return remaining
+
+
+def read_gaps(queryset, gaps, fields):
+    """
+    Reads the rows of a queryset whose ids are in ranges of missing ids.
+
+    :param gaps: A list of [first id, last id, time] ranges, see find_gaps.
+    :return: A list of tuples of the id and the values of fields, ordered by
+        id.
+    """
+    rows = []
+    for start in xrange(0, len(gaps), MAX_RANGES):
+        ranges = Q()
+        for first, last, _ in gaps[start:start + MAX_RANGES]:
+            ranges |= Q(id__range=(first, last))
+        rows.extend(queryset.filter(ranges).values_list('id', *fields))
+    return sorted(rows)
+
+
+def process_new_rows(name, queryset, fields, process, batch_size):
+    """
+    Runs a job over the rows of a queryset added since its last run. Rows
+    are read in batches; each batch is processed and committed in a single
+    transaction together with the checkpoint of the job, so the job can be
+    interrupted and rerun at any time. Ids that were missing below the
+    checkpoint are read again at the start of each run, so rows committed
+    after rows with larger ids are processed too, exactly once.
+
+    :param name: The name of the job, see Checkpoint.
+    :param queryset: The rows processed by the job.
+    :param fields: The fields to read.
+    :param process: A function called with the list of rows of each batch,
+        as tuples of the values of fields.
+    :param batch_size: The number of rows read per transaction.
+    :return: The number of rows read.
+    """
+    processed = 0
+    rescan = True
+    while True:
+        with transaction.atomic():
+            Checkpoint.objects.get_or_create(name=name)
+            checkpoint = Checkpoint.objects.select_for_update().get(name=name)
+            now = time.time()
+            gaps = json.loads(checkpoint.gaps)
+            late = read_gaps(queryset, gaps, fields) if rescan else []
+            rows = list(queryset.filter(id__gt=checkpoint.last_id).
+                        order_by('id').values_list('id', *fields)[:batch_size])
+            if late or rows:
+                process([row[1:] for row in late + rows])
+            if rescan:
+                gaps = fill_gaps(gaps, [row[0] for row in late], now)
+            gaps += find_gaps([row[0] for row in rows], checkpoint.last_id, now)
+            if rows:
+                checkpoint.last_id = rows[-1][0]
+            checkpoint.gaps = json.dumps(gaps)
+            checkpoint.save()
+        processed += len(late) + len(rows)
+        rescan = False
+        if len(rows) < batch_size:
+            break
+    return processed
+
+
+def compact_ratings(batch_size=BATCH_SIZE):
+    """
+    Adds the ratings stored since the last run to the daily rating rollups
+    and to the joke statistics.
+
+    :param batch_size: The number of ratings read per transaction.
+    :return: The number of ratings added to the rollups.
+    """
+    process_new_rows(JOKE_STATISTICS, Rating.objects, ('joke_id', 'rating'),
+                     update_joke_stats, batch_size)
+    return process_new_rows(RATING_ROLLUP, Rating.objects,
+                            ('timestamp', 'joke_id', 'rating_type', 'rating'),
+                            rollup_ratings, batch_size)
+
+
+def rollup_ratings(ratings):
+    """
+    Adds ratings to the daily rating rollups. Ratings without a timestamp
+    (i.e imported ratings) are skipped.
+
+    :param ratings: A list of (timestamp, joke id, rating type, rating) tuples.
+    """
+    summaries = {}
+    for timestamp, joke_id, rating_type, rating in ratings:
+        if timestamp is None:
+            continue
+        rating /= RATING_SCALE
+        key = (timestamp.date(), joke_id, rating_type, rating_bin(rating))
+        summary = summaries.setdefault(key, [0, 0.0, 0])
+        summary[0] += 1
+        summary[1] += rating
+        summary[2] += rating == 0
+    if not summaries:
+        return
+
+    dates = set(date for date, _, _, _ in summaries)
+    existing = {}
+    for rollup in RatingRollup.objects.filter(date__in=dates).only(
+            'date', 'joke', 'rating_type', 'bin'):
+        key = (rollup.date, rollup.joke_id, rollup.rating_type, rollup.bin)
+        existing[key] = rollup.id
+
+    rollups = []
+    for key, (count, total, zeros) in summaries.items():
+        if key in existing:
+            RatingRollup.objects.filter(id=existing[key]).update(
+                count=F('count') + count, total=F('total') + total,
+                zeros=F('zeros') + zeros)
+        else:
+            date, joke_id, rating_type, idx = key
+            rollups.append(RatingRollup(date=date, joke_id=joke_id,
+                                        rating_type=rating_type, bin=idx,
+                                        count=count, total=total, zeros=zeros))
+    RatingRollup.objects.bulk_create(rollups)
+
+
+def update_joke_stats(ratings):
+    """
+    Adds ratings to the running statistics of their jokes.
+
+    :param ratings: A list of (joke id, rating) tuples.
+    """
+    summaries = {}
+    for joke_id, rating in ratings:
+        rating /= RATING_SCALE
+        summary = summaries.setdefault(joke_id, [0, 0.0, 0.0])
+        summary[0] += 1
+        summary[1] += rating
+        summary[2] += rating * rating
+
+    existing = set(JokeStats.objects.filter(joke__in=summaries.keys()).
+                   values_list('joke_id', flat=True))
+    new_stats = []
+    for joke_id, (count, total, squares) in summaries.items():
+        if joke_id in existing:
+            JokeStats.objects.filter(joke=joke_id).update(
+                count=F('count') + count, total=F('total') + total,
+                squares=F('squares') + squares)
+        else:
+            new_stats.append(JokeStats(joke_id=joke_id, count=count,
+                                       total=total, squares=squares))
+    JokeStats.objects.bulk_create(new_stats)
+
+
+def top_jokes(order_by, n):
+    """
+    Ranks the jokes by the mean or the variance of their ratings, using the
+    joke statistics.
+
+    :param order_by: Either 'mean' or 'variance'.
+    :param n: The number of jokes to return.
+    :return: A list of up to n (joke id, mean, variance, number of ratings)
+        tuples, ordered from the highest to the lowest mean or variance.
+    """
+    stats = list(JokeStats.objects.filter(count__gt=0).
+                 values_list('joke_id', 'count', 'total', 'squares'))
+    if not stats:
+        return []
+    joke_ids, counts, totals, squares = [np.array(column) for column
+                                         in zip(*stats)]
+    means = totals / counts
+    # Rounding errors can make the variance of constant ratings negative
+    variances = np.maximum(squares / counts - means ** 2, 0)
+    keys = means if order_by == 'mean' else variances
+    # Ties are broken in favour of the lowest joke id
+    order = np.lexsort((joke_ids, -keys))[:n]
+    return zip(joke_ids[order].tolist(), means[order].tolist(),
+               variances[order].tolist(), counts[order].tolist())
+
+
+def compact_user_logs(batch_size=BATCH_SIZE):
+    """
+    Adds the user logs stored since the last run to the rater sessions.
+
+    :param batch_size: The number of logs read per transaction.
+    :return: The number of logs read.
+    """
+    return process_new_rows(RATER_SESSIONS, UserLog.objects,
+                            ('user_id', 'timestamp', 'action_type'),
+                            sessionize_logs, batch_size)
+
+
+def sessionize_logs(logs):
+    """
+    Adds user logs to the sessions of their raters. A log continues the
+    latest session of its rater if it is less than SESSION_TIMEOUT away
+    from it, and otherwise starts a new session. Logs are buffered before
+    they are inserted, so a log may be older than the latest session; it
+    is then merged into that session if it is close enough, and otherwise
+    starts a session of its own.
+
+    :param logs: A list of (user id, timestamp, action type) tuples.
+    """
+    actions = {}
+    for user_id, timestamp, action_type in logs:
+        actions.setdefault(user_id, []).append((timestamp, action_type))
+
+    # Load the latest session of each rater. The end of the latest session
+    # is read from the (user, end) index, so the earlier sessions of the
+    # raters are never loaded.
+    latest = {}
+    user_ids = sorted(actions)
+    for start in xrange(0, len(user_ids), MAX_IN_CLAUSE):
+        batch = user_ids[start:start + MAX_IN_CLAUSE]
+        ends = dict(RaterSession.objects.filter(user__in=batch).
+                    values_list('user').annotate(Max('end')))
+        sessions = RaterSession.objects.filter(user__in=batch,
+                                               end__in=set(ends.values()))
+        for session in sessions.order_by('id'):
+            if session.end == ends[session.user_id]:
+                latest[session.user_id] = session
+
+    new_sessions = []
+    for user_id, user_actions in actions.items():
+        user_actions.sort()
+        session = latest.get(user_id)
+        if session is not None:
+            # Logs much older than the latest session form sessions of their
+            # own, the other logs continue from the latest session
+            late = [action for action in user_actions if
+                    action[0] < session.start - SESSION_TIMEOUT]
+            new_sessions.extend(build_sessions(user_id, None, late))
+            user_actions = user_actions[len(late):]
+        new_sessions.extend(build_sessions(user_id, session, user_actions))
+    RaterSession.objects.bulk_create(new_sessions)
+
+
+def build_sessions(user_id, session, actions):
+    """
+    Splits the actions of a rater into sessions. The existing session is
+    saved if any action is added to it.
+
+    :param user_id: The id of the rater.
+    :param session: The session continued by the actions, or None.
+    :param actions: A sorted list of (timestamp, action type) tuples, none of
+        which is older than session.start - SESSION_TIMEOUT.
+    :return: A list of the sessions that were created.
+    """
+    created = []
+    existing, extended = session, False
+    for timestamp, action_type in actions:
+        if session is None or timestamp > session.end + SESSION_TIMEOUT:
+            session = RaterSession(user_id=user_id, start=timestamp,
+                                   end=timestamp)
+            created.append(session)
+        elif session is existing:
+            extended = True
+        session.start = min(session.start, timestamp)
+        session.end = max(session.end, timestamp)
+        session.actions += 1
+        session.ratings += action_type == UserActionType.RATING
+    if extended:
+        existing.save()
+    return created
@@ -1,3 +1,583 @@
-from django.test import TestCase
+import json
+import logging
+import re
+import threading
+import time
+import numpy as np
+from datetime import timedelta
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+from eigentaste import Eigentaste, StoredEigentasteModel, Point
+from eigentaste.cluster_grid import ClusterGrid
+from eigentaste.evaluation import replay
+from eigentaste.model_cache import model_cache
+from jester.models import Checkpoint, Joke, JokeStats, Rater, Rating, \
+    RatingRollup, RatingType, RecommenderLog, RecommenderModel, \
+    UserActionType, UserLog
+from jester.joke_catalog import invalidate_joke_catalog
+from jester.log_buffer import LogBuffer, log_buffer
+import jester.log_buffer
+from jester.rater_state import RaterState
+from jester.rollups import GAP_TIMEOUT, RATING_ROLLUP, compact_ratings, \
+    fill_gaps, find_gaps
+from jester.views import GAUGE_SET, MAX_BATCH_SIZE, OLD_JOKES
 
-# Create your tests here.
+
+def random_ratings(users, jokes, gauge, seed=0):
+    """
+    :return: A users x jokes matrix of random ratings, where about half of the
+        ratings are missing. The gauge set jokes are rated by every user.
+    """
+    rng = np.random.RandomState(seed)
+    ratings = rng.uniform(-10, 10, (users, jokes))
+    ratings[rng.rand(users, jokes) < 0.5] = np.nan
+    ratings[:, gauge] = rng.uniform(-10, 10, (users, len(gauge)))
+    return ratings
+
+
+def setUpModule():
+    # The background thread of the log buffer has its own connection, which
+    # does not see the in-memory test db. The tests that log flush the
+    # buffer on their own thread instead, into their transaction.
+    log_buffer.close()
+
+
+class ClusterGridTest(SimpleTestCase):
+
+    def setUp(self):
+        self.gauge = [3, 11]
+        self.model = Eigentaste(random_ratings(1000, 20, self.gauge), self.gauge)
+        self.rng = np.random.RandomState(1)
+
+    def argmin_rule(self, point):
+        """The classification rule the grid replaces."""
+        point = Point(*point)
+        distances = [cluster.distance(point) for cluster in self.model.clusters]
+        return np.argmin(distances)
+
+    def sample_points(self, n):
+        x, y = self.model.pca_data.T
+        # Cover the whole plane, including points outside the clusters
+        xs = self.rng.uniform(1.2 * np.min(x), 1.2 * np.max(x), n)
+        ys = self.rng.uniform(1.2 * np.min(y), 1.2 * np.max(y), n)
+        points = zip(xs, ys)
+        # Points on the edges and corners of the clusters
+        for cluster in self.model.clusters:
+            mid = (cluster.top_left + cluster.bottom_right) / 2
+            for px in (cluster.top_left.x, mid.x, cluster.bottom_right.x):
+                for py in (cluster.top_left.y, mid.y, cluster.bottom_right.y):
+                    points.append((px, py))
+        return points + [tuple(user) for user in self.model.pca_data]
+
+    def assert_agrees(self, grid):
+        for point in self.sample_points(5000):
+            self.assertEqual(grid.classify(point), self.argmin_rule(point))
+
+    def test_grid_agrees_with_argmin(self):
+        self.assert_agrees(ClusterGrid.build(self.model.clusters))
+
+    def test_coarse_and_fine_grids_agree_with_argmin(self):
+        for resolution in (1, 3, 7, 64):
+            self.assert_agrees(ClusterGrid.build(self.model.clusters, resolution))
+
+    def test_most_cells_have_a_single_candidate(self):
+        grid = ClusterGrid.build(self.model.clusters)
+        candidates = np.diff(grid.offsets)
+        self.assertTrue(np.all(candidates >= 1))
+        self.assertGreater(np.mean(candidates == 1), 0.5)
+
+    def test_stored_models_classify_with_grid(self):
+        stored_model = StoredEigentasteModel(json.dumps(self.model.export_model()))
+        for point in self.sample_points(500):
+            self.assertEqual(stored_model.classify(point), self.argmin_rule(point))
+
+
+class ReplayTest(TestCase):
+    """
+    Checks that the batched replay of eigentaste.evaluation recommends the
+    same jokes as the server, which recommends one joke at a time from the
+    RaterState of each rater.
+    """
+    def setUp(self):
+        self.gauge = [3, 11]
+        self.model = StoredEigentasteModel.from_arrays(Eigentaste(
+            random_ratings(1000, 60, self.gauge), self.gauge).export_arrays())
+        self.joke_cluster_ids = {}
+        for idx, joke_cluster in enumerate(self.model.joke_clusters):
+            for joke_idx in joke_cluster.indices:
+                self.joke_cluster_ids[int(joke_idx)] = idx
+        # Every joke is rated, so every recommendation updates the state
+        self.ratings = np.random.RandomState(1).uniform(-10, 10, (20, 60))
+
+    def tearDown(self):
+        log_buffer.flush()
+
+    def replayed_jokes(self, steps):
+        """
+        :return: A users x steps array of the jokes recommended by replay.
+        """
+        recommended = []
+        recommend_jokes = self.model.recommend_jokes
+
+        def record(*args):
+            joke_ids, item_cluster_idx, averages = recommend_jokes(*args)
+            recommended.append(joke_ids.copy())
+            return joke_ids, item_cluster_idx, averages
+        self.model.recommend_jokes = record
+        try:
+            replay(self.model, self.ratings, np.arange(len(self.ratings)),
+                   self.gauge, steps, chunk_size=7)
+        finally:
+            self.model.recommend_jokes = recommend_jokes
+        # Each chunk of users is replayed for all the steps in turn
+        chunks = [np.array(recommended[start:start + steps]).T for start
+                  in xrange(0, len(recommended), steps)]
+        return np.concatenate(chunks)
+
+    def rate(self, rater, joke_idx, rating):
+        model = rater.load_model()
+        model.rate(self.joke_cluster_ids[joke_idx], rating)
+        model.mark_rated(joke_idx + 1)
+        rater.state = model.pack()
+
+    def served_jokes(self, ratings, steps):
+        """
+        :return: The jokes recommended to a rater by the server.
+        """
+        rater = Rater.objects.create()
+        cluster_id = self.model.classify(self.model.transform(ratings[self.gauge]))
+        rater.state = RaterState.create(
+            cluster_id, self.model.moving_averages(cluster_id)).pack()
+        for joke_idx in self.gauge:
+            self.rate(rater, joke_idx, ratings[joke_idx])
+        jokes = []
+        for _ in range(steps):
+            joke_id = self.model.recommend_joke(rater)
+            self.rate(rater, joke_id - 1, ratings[joke_id - 1])
+            jokes.append(joke_id)
+        return jokes
+
+    def test_replay_matches_server(self):
+        steps = 10
+        replayed = self.replayed_jokes(steps)
+        self.assertEqual(replayed.shape, (len(self.ratings), steps))
+        for ratings, jokes in zip(self.ratings, replayed):
+            self.assertEqual(self.served_jokes(ratings, steps), jokes.tolist())
+
+    def test_nothing_compared(self):
+        ratings = np.empty((5, 60))
+        ratings.fill(np.nan)
+        result = replay(self.model, ratings, np.arange(5), self.gauge, 10)
+        self.assertEqual(result['users'], 0)
+        self.assertTrue(np.isnan(result['nmae']))
+        self.assertTrue(np.isnan(result['hit rate']))
+
+
+class RateJokesTest(TestCase):
+    """
+    Tests the batch rating endpoint, in particular around the gauge set.
+    """
+    model = None
+
+    @classmethod
+    def train_model(cls):
+        """
+        :return: An Eigentaste model of the old jokes, trained once for all
+            the tests.
+        """
+        if cls.model is None:
+            gauge = [joke_id - 1 for joke_id in GAUGE_SET]
+            cls.model = Eigentaste(random_ratings(500, OLD_JOKES, gauge), gauge)
+        return cls.model
+
+    def setUp(self):
+        model = self.train_model()
+        cluster_ids = {}
+        for idx, joke_cluster in enumerate(model.joke_clusters):
+            for joke_idx in joke_cluster.indices:
+                cluster_ids[joke_idx + 1] = idx
+        for joke_id in range(1, OLD_JOKES + 3):
+            model_params = json.dumps({'cluster id': cluster_ids[joke_id]}) \
+                if joke_id in cluster_ids else ''
+            Joke.objects.create(id=joke_id, joke_text='', model_params=model_params)
+        recommender_model = RecommenderModel()
+        recommender_model.store(model)
+        recommender_model.save()
+        # Model versions are row ids, which are reused by the test db
+        model_cache.clear()
+
+    def tearDown(self):
+        log_buffer.flush()
+
+    def rate(self, pairs):
+        return self.client.post('/jester/rate_jokes/', json.dumps(pairs),
+                                content_type='application/json')
+
+    def rater(self):
+        return Rater.objects.get()
+
+    def test_gauge_set(self):
+        response = self.rate([[GAUGE_SET[0], 1.5], [GAUGE_SET[1], -2.5]])
+        self.assertEqual(response.status_code, 200)
+        rater = self.rater()
+        self.assertEqual(rater.jokes_rated, len(GAUGE_SET))
+        self.assertEqual(rater.load_model().rated_ids(), sorted(GAUGE_SET))
+
+    def test_gauge_set_in_two_batches(self):
+        self.assertEqual(self.rate([[GAUGE_SET[0], 1.5]]).status_code, 200)
+        self.assertIsNone(self.rater().state)
+        self.assertEqual(self.rate([[GAUGE_SET[1], -2.5]]).status_code, 200)
+        self.assertEqual(self.rater().load_model().rated_ids(), sorted(GAUGE_SET))
+
+    def test_batch_after_gauge_set(self):
+        self.assertEqual(self.rate([[GAUGE_SET[0], 1.5],
+                                    [GAUGE_SET[1], -2.5]]).status_code, 200)
+        response = self.rate([[1, 3.25], [OLD_JOKES + 1, -7]])
+        self.assertEqual(response.status_code, 200)
+        rater = self.rater()
+        self.assertEqual(rater.jokes_rated, len(GAUGE_SET) + 2)
+        self.assertEqual(rater.load_model().rated_ids(),
+                         sorted(GAUGE_SET + [1, OLD_JOKES + 1]))
+        self.assertEqual(Rating.objects.get(joke=1).to_float(), 3.25)
+
+    def test_joke_without_cluster(self):
+        self.rate([[GAUGE_SET[0], 1.5], [GAUGE_SET[1], -2.5]])
+        before = self.rater().load_model()
+        Joke.objects.filter(id=1).update(model_params='')
+        invalidate_joke_catalog()
+        self.assertEqual(self.rate([[1, 3.25]]).status_code, 200)
+        after = self.rater().load_model()
+        # No joke cluster counts the rating
+        self.assertEqual(after.jokes_rated.tolist(), before.jokes_rated.tolist())
+        self.assertEqual(after.rated_ids(), sorted(GAUGE_SET + [1]))
+
+    def test_batch_across_gauge_set(self):
+        response = self.rate([[GAUGE_SET[0], 1.5], [GAUGE_SET[1], -2.5],
+                              [2, 0]])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.rater().load_model().rated_ids(),
+                         sorted(GAUGE_SET + [2]))
+
+    def test_gauge_set_must_be_rated_first(self):
+        self.assertEqual(self.rate([[1, 1], [GAUGE_SET[0], 1]]).status_code, 400)
+        self.assertEqual(Rating.objects.count(), 0)
+
+    def test_malformed_bodies(self):
+        for body in ['', 'not json', '{"8": 1}', '[8, 1]', '[[8]]',
+                     '[["joke", 1]]', '[[8, "rating"]]', '[[8, null]]',
+                     '[[8, NaN]]', '[[8, Infinity]]', '[[8, -Infinity]]',
+                     '[[8, 500]]', '[[8, 1e12]]', '[[8, -10.5]]',
+                     '[[8, 1, 7]]', '[[8, 1, 1, 1]]']:
+            response = self.client.post('/jester/rate_jokes/', body,
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 400, body)
+        self.assertEqual(Rating.objects.count(), 0)
+
+    def test_rating_types(self):
+        self.rate([[GAUGE_SET[0], -10, RatingType.GAUGE],
+                   [GAUGE_SET[1], 10, RatingType.GAUGE]])
+        Rater.objects.update(last_requested_joke_type=RatingType.RANDOM)
+        response = self.rate([[1, 0, RatingType.RECOMMENDED], [2, 0]])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Rating.objects.get(joke=1).rating_type,
+                         RatingType.RECOMMENDED)
+        self.assertEqual(Rating.objects.get(joke=2).rating_type,
+                         RatingType.RANDOM)
+
+    def test_unknown_joke(self):
+        response = self.rate([[GAUGE_SET[0], 1], [GAUGE_SET[1], 1],
+                              [OLD_JOKES + 100, 1]])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Rating.objects.count(), 0)
+
+    def test_duplicate_jokes(self):
+        self.rate([[GAUGE_SET[0], 1], [GAUGE_SET[1], 1]])
+        self.assertEqual(self.rate([[1, 1], [1, 2]]).status_code, 400)
+        self.assertEqual(Rating.objects.count(), len(GAUGE_SET))
+
+    def test_batch_size(self):
+        self.rate([[GAUGE_SET[0], 1], [GAUGE_SET[1], 1]])
+        pairs = [[1, 0]] * (MAX_BATCH_SIZE + 1)
+        self.assertEqual(self.rate(pairs).status_code, 400)
+        self.assertEqual(Rating.objects.count(), len(GAUGE_SET))
+
+
+def query_plan(queryset):
+    """
+    :return: The query plan of a queryset on the test database, as a string.
+    """
+    sql, params = queryset.query.sql_with_params()
+    explain = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+    cursor = connection.cursor()
+    cursor.execute(explain + sql, params)
+    return '\n'.join(' '.join(unicode(column) for column in row)
+                     for row in cursor.fetchall())
+
+
+class GapsTest(SimpleTestCase):
+    """
+    Tests the bookkeeping of the ids missing below a checkpoint.
+    """
+    def test_find_gaps(self):
+        self.assertEqual(find_gaps([3, 4, 8], 1, 10), [[2, 2, 10], [5, 7, 10]])
+        self.assertEqual(find_gaps([2, 3], 1, 10), [])
+        self.assertEqual(find_gaps([], 1, 10), [])
+
+    def test_fill_gaps_splits_ranges(self):
+        gaps = [[5, 9, 0]]
+        self.assertEqual(fill_gaps(gaps, [7], 10), [[5, 6, 0], [8, 9, 0]])
+        self.assertEqual(fill_gaps(gaps, [5, 9], 10), [[6, 8, 0]])
+        self.assertEqual(fill_gaps(gaps, [6, 8, 20], 10), [[5, 5, 0], [7, 7, 0],
+                                                           [9, 9, 0]])
+        self.assertEqual(fill_gaps(gaps, range(5, 10), 10), [])
+        self.assertEqual(fill_gaps(gaps, [], 10), gaps)
+
+    def test_fill_gaps_drops_expired_ranges(self):
+        gaps = [[5, 9, 0], [20, 20, 100]]
+        self.assertEqual(fill_gaps(gaps, [], GAP_TIMEOUT), gaps)
+        self.assertEqual(fill_gaps(gaps, [], GAP_TIMEOUT + 50), [[20, 20, 100]])
+        self.assertEqual(fill_gaps(gaps, [], GAP_TIMEOUT + 101), [])
+
+
+class CompactRatingsTest(TestCase):
+    """
+    Checks that ratings committed after ratings with larger ids are added to
+    the rollups and the joke statistics exactly once.
+    """
+    def setUp(self):
+        self.jokes = [Joke.objects.create(joke_text='') for _ in range(3)]
+        self.user = Rater.objects.create()
+        self.ratings = {}
+
+    def rate(self, *ids):
+        for rating_id in ids:
+            rating = Rating.objects.create(
+                id=rating_id, user=self.user, joke=self.jokes[rating_id % 3],
+                rating=rating_id * 1000, timestamp=timezone.now(),
+                rating_type=RatingType.RECOMMENDED)
+            self.ratings[rating_id] = rating
+
+    def assert_counted_once(self):
+        for joke in self.jokes:
+            ratings = [rating.to_float() for rating in self.ratings.values()
+                       if rating.joke_id == joke.id]
+            stats = JokeStats.objects.get(joke=joke)
+            self.assertEqual(stats.count, len(ratings))
+            self.assertAlmostEqual(stats.total, sum(ratings))
+            rollups = RatingRollup.objects.filter(joke=joke)
+            self.assertEqual(sum(rollup.count for rollup in rollups), len(ratings))
+            self.assertAlmostEqual(sum(rollup.total for rollup in rollups),
+                                   sum(ratings))
+
+    def test_late_ratings_are_counted_once(self):
+        self.rate(1, 2, 5, 6, 9)
+        self.assertEqual(compact_ratings(batch_size=2), 5)
+        gaps = json.loads(Checkpoint.objects.get(name=RATING_ROLLUP).gaps)
+        self.assertEqual([gap[:2] for gap in gaps], [[3, 4], [7, 8]])
+        self.assert_counted_once()
+
+        # Ratings committed behind the checkpoint, and after it
+        self.rate(4, 8, 10)
+        self.assertEqual(compact_ratings(batch_size=2), 3)
+        gaps = json.loads(Checkpoint.objects.get(name=RATING_ROLLUP).gaps)
+        self.assertEqual([gap[:2] for gap in gaps], [[3, 3], [7, 7]])
+        self.assert_counted_once()
+
+        self.rate(3, 7)
+        self.assertEqual(compact_ratings(), 2)
+        self.assertEqual(compact_ratings(), 0)
+        self.assertEqual(Checkpoint.objects.get(name=RATING_ROLLUP).gaps, '[]')
+        self.assert_counted_once()
+
+
+class RecordingHandler(logging.Handler):
+    """
+    Keeps the records logged by a logger.
+    """
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class RecordingLogBuffer(LogBuffer):
+    """
+    Log buffer that keeps the rows it flushes instead of inserting them,
+    since the background thread cannot see the in-memory test db.
+    """
+    def __init__(self, max_size, flush_interval, failures=0):
+        """
+        :param failures: The number of flushes that fail, before the others.
+        """
+        LogBuffer.__init__(self, max_size, flush_interval)
+        self.failures = failures
+        self.flushed = []
+        self.flushes = threading.Semaphore(0)
+
+    def flush(self):
+        with self.lock:
+            entries, self.entries = self.entries, []
+            self.full.clear()
+        try:
+            if self.failures:
+                self.failures -= 1
+                raise RuntimeError('Flush failed')
+            self.flushed.extend(entries)
+        finally:
+            self.flushes.release()
+
+
+class FailingModel(object):
+    """
+    Model whose rows cannot be inserted.
+    """
+    class objects(object):
+        @staticmethod
+        def bulk_create(batch):
+            raise ValueError('Cannot insert {0} rows'.format(len(batch)))
+
+
+class LogBufferTest(TestCase):
+
+    def setUp(self):
+        self.user = Rater.objects.create()
+        self.handler = RecordingHandler()
+        jester.log_buffer.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        jester.log_buffer.logger.removeHandler(self.handler)
+
+    def user_log(self):
+        return UserLog(user=self.user, timestamp=timezone.now(), action='',
+                       action_type=UserActionType.RATING)
+
+    def wait(self, buffer, timeout=10):
+        """
+        Waits until the buffer has been flushed once more.
+
+        :return: False if the buffer was not flushed within timeout seconds.
+        """
+        deadline = time.time() + timeout
+        while not buffer.flushes.acquire(False):
+            if time.time() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def test_flush_inserts_rows_of_each_model(self):
+        buffer = LogBuffer(100, 3600)
+        buffer.add(self.user_log())
+        buffer.add(RecommenderLog(user=self.user, action=''))
+        buffer.add(self.user_log())
+        buffer.flush()
+        self.assertEqual(UserLog.objects.count(), 2)
+        self.assertEqual(RecommenderLog.objects.count(), 1)
+        self.assertEqual(buffer.entries, [])
+        buffer.close()
+
+    def test_failed_batches_are_dropped(self):
+        buffer = LogBuffer(100, 3600)
+        buffer.add(FailingModel())
+        buffer.add(self.user_log())
+        buffer.flush()
+        self.assertEqual(UserLog.objects.count(), 1)
+        self.assertEqual(len(self.handler.records), 1)
+        buffer.close()
+
+    def test_thread_flushes_full_buffer(self):
+        buffer = RecordingLogBuffer(2, 3600)
+        buffer.add(1)
+        buffer.add(2)
+        self.assertTrue(self.wait(buffer))
+        self.assertEqual(buffer.flushed, [1, 2])
+        buffer.close()
+
+    def test_close_flushes_and_stops_the_thread(self):
+        buffer = RecordingLogBuffer(100, 3600)
+        buffer.add(1)
+        thread = buffer.thread
+        self.assertTrue(thread.is_alive())
+        buffer.close()
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(buffer.flushed, [1])
+        # A closed buffer does not start a new thread
+        buffer.add(2)
+        self.assertIs(buffer.thread, thread)
+
+    def test_thread_survives_a_failed_flush(self):
+        buffer = RecordingLogBuffer(1, 3600, failures=1)
+        buffer.add(1)
+        self.assertTrue(self.wait(buffer))
+        buffer.add(2)
+        self.assertTrue(self.wait(buffer))
+        self.assertTrue(buffer.thread.is_alive())
+        self.assertEqual(buffer.flushed, [2])
+        self.assertEqual(len(self.handler.records), 1)
+        buffer.close()
+
+    def test_dead_thread_is_restarted(self):
+        buffer = RecordingLogBuffer(100, 3600)
+        dead = threading.Thread(target=lambda: None)
+        dead.start()
+        dead.join()
+        buffer.thread = dead
+        buffer.add(1)
+        self.assertIsNot(buffer.thread, dead)
+        self.assertTrue(buffer.thread.is_alive())
+        buffer.close()
+        self.assertEqual(buffer.flushed, [1])
+
+
+class QueryPlanTest(TestCase):
+    """
+    Checks that the hot lookups on the rating and user log tables use the
+    indexes added for them (see jester.models).
+    """
+    # How the query plan of each database shows that no table rows are read
+    COVERING = {'sqlite': 'COVERING INDEX', 'mysql': 'Using index'}
+
+    def setUp(self):
+        jokes = [Joke.objects.create(joke_text='') for _ in range(10)]
+        self.user = Rater.objects.create()
+        now = timezone.now()
+        for rater in [self.user, Rater.objects.create()]:
+            for idx, joke in enumerate(jokes):
+                timestamp = now - timedelta(hours=idx)
+                Rating.objects.create(user=rater, joke=joke, rating=idx,
+                                      timestamp=timestamp)
+                UserLog.objects.create(user=rater, timestamp=timestamp,
+                                       action='', action_type=UserActionType.RATING)
+        self.start, self.end = now - timedelta(days=1), now
+
+    def assert_uses_index(self, plan, table, column):
+        """
+        Asserts that the plan uses an index created by index_together, whose
+        first column is column.
+        """
+        self.assertRegexpMatches(plan, r'\b{0}_{1}_[0-9a-f]+_idx\b'.format(
+            re.escape(table), re.escape(column)))
+
+    def test_rating_by_user_and_joke(self):
+        plan = query_plan(Rating.objects.filter(user=self.user, joke=1))
+        self.assert_uses_index(plan, Rating._meta.db_table, 'user_id')
+
+    def test_gauge_set_ratings(self):
+        plan = query_plan(Rating.objects.filter(user=self.user, joke__in=[7, 8]).
+                          order_by('joke'))
+        self.assert_uses_index(plan, Rating._meta.db_table, 'user_id')
+
+    def test_ratings_in_date_range(self):
+        plan = query_plan(Rating.objects.filter(
+            timestamp__range=(self.start, self.end)).values_list('rating'))
+        self.assert_uses_index(plan, Rating._meta.db_table, 'timestamp')
+        if connection.vendor in self.COVERING:
+            self.assertIn(self.COVERING[connection.vendor], plan)
+
+    def test_user_logs_in_date_range(self):
+        plan = query_plan(UserLog.objects.filter(
+            user=self.user, timestamp__range=(self.start, self.end)).
+            order_by('timestamp'))
+        self.assert_uses_index(plan, UserLog._meta.db_table, 'user_id')
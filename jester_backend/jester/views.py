@@ -1,14 +1,18 @@
-from eigentaste import StoredEigentasteModel, JOKE_CLUSTERS
-from django.contrib.auth import authenticate, login, logout
-from django.http import HttpResponse
+from eigentaste import get_stored_model
+from django.contrib.auth import logout
+from django.db import transaction
+from django.http import HttpResponse, HttpResponseBadRequest
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 from jester.models import *
+from jester.joke_catalog import get_joke_catalog
+from jester.rollups import MIN_RATING, MAX_RATING
 from jester import *
 from random import SystemRandom
 
 
 GAUGE_SET_SIZE = 2
 GAUGE_SET = [8, 54]
-GAUGE_SET_JOKES = [Joke.objects.get(id=8), Joke.objects.get(id=54)]
 
 # Probability of displaying a random joke
 PROB_RANDOM_JOKE = 0.30 # For testing purposes
@@ -22,9 +26,22 @@ OLD_JOKES = 128
 # Number of ratings after gauge set before we display random jokes
 RANDOM_THRESH = 5
 
+# Maximum number of ratings that can be submitted in one batch
+MAX_BATCH_SIZE = 500
+
+# Session key under which the id of an anonymous Rater is stored
+RATER_SESSION_KEY = 'rater_id'
+
 rng = SystemRandom()  # Random Number Generator
 
 
+def joke_catalog():
+    """
+    :return: The in-memory catalog of all jokes.
+    """
+    return get_joke_catalog(OLD_JOKES)
+
+
 def delete_all_users():
     """
     Deletes all users from the database.
@@ -36,20 +53,24 @@ def delete_all_users():
 def get_user(request):
     """
     Obtains the user making the request. If this user is new to the Jester system
-    then this function creates a new entry in the auth_users tables. If the user
-    has pre-existing credentials, then this function authenticates the user.
+    then this function creates a new anonymous Rater, whose id is allocated by
+    the db and stored in the user's session. No auth_user entry is created and
+    no password is hashed. Users created before anonymous raters existed are
+    still identified by their auth_user credentials.
 
     :return: A 'Rater' object that represents the user making the request.
     """
-    if not request.user.is_authenticated():
-        username = password = str(User.objects.count() + 1)
-        User.objects.create_user(username, password=password)
-        user = authenticate(username=username, password=password)
-        user.rater = Rater.objects.create(user=user)
-        login(request, user)
-    else:
-        user = request.user
-    return user.rater
+    if request.user.is_authenticated():
+        return request.user.rater
+    rater_id = request.session.get(RATER_SESSION_KEY)
+    if rater_id is not None:
+        try:
+            return Rater.objects.get(id=rater_id)
+        except Rater.DoesNotExist:
+            pass
+    rater = Rater.objects.create()
+    request.session[RATER_SESSION_KEY] = rater.id
+    return rater
 
 
 def request_joke(request):
@@ -64,47 +85,49 @@ def request_joke(request):
         }
     """
     user = get_user(request)
+    catalog = joke_catalog()
     stale, random, gauge = True, False, False
 
     if not user.stale:  # User did not submit rating for last joke
-        joke = user.last_requested_joke
+        joke = catalog.get(user.last_requested_joke_id)
         stale = False
     elif user.jokes_rated < GAUGE_SET_SIZE:
         joke_id = GAUGE_SET[user.jokes_rated]  # Get joke id of gauge set.
-        joke = Joke.objects.get(id=joke_id)  # Load the joke from db.
+        joke = catalog.get(joke_id)
         gauge = True
     elif (user.jokes_rated > GAUGE_SET_SIZE + RANDOM_THRESH
           and rng.random() < PROB_RANDOM_JOKE):  # Choose a random unrated joke
-        user_model = user.load_model()
-        flag = True
+        sampler = catalog.sampler
+        model = user.load_model()
+        joke_id = None
         if rng.random() < PROB_NEW_JOKE:  # Choose a random joke out of set of new jokes
-            unrated_jokes = (Joke.objects.filter(id__gt=OLD_JOKES).
-                             exclude(id__in=user_model['rated ids']))
-            flag = False
-        if flag or unrated_jokes.count() == 0:  # Choose random joke out of unrated jokes
-            unrated_jokes = Joke.objects.exclude(id__in=user_model['rated ids'])
+            joke_id = sampler.sample(rng, model, new=True)
+        if joke_id is None:  # Choose random joke out of unrated jokes
+            joke_id = sampler.sample(rng, model)
 
-        joke = rng.choice(unrated_jokes)
+        joke = catalog.get(joke_id)
         random = True
     else:  # Use Eigentaste to select a joke
-        joke = recommend_joke(user)
+        joke = catalog.get(recommend_joke(user))
 
     if stale:  # User needs a new joke
         user.requested_new_joke(joke, random, gauge)
     log_request_joke(request, user, joke, stale, random, gauge)
 
     # Return the joke as a JSON object
-    response = {'joke_id': joke.id, 'joke_text': joke.joke_text, 'num_jokes_rated': user.jokes_rated}
-    return HttpResponse(json.dumps(response), content_type="application/json")
+    response = catalog.response(joke.id, user.jokes_rated)
+    return HttpResponse(response, content_type="application/json")
 
 
 def recommend_joke(user):
-    recommender_model = RecommenderModel.objects.get()
-    stored_model = StoredEigentasteModel(recommender_model.data)
-    joke = stored_model.recommend_joke(user)
-    prediction = stored_model.get_prediction(user, joke)
-    log_prediction(user, joke, prediction)
-    return joke
+    """
+    :return: The id of the joke recommended to the user by Eigentaste.
+    """
+    stored_model = get_stored_model()
+    joke_id = stored_model.recommend_joke(user)
+    prediction = stored_model.get_prediction(user, joke_id)
+    log_prediction(user, joke_catalog().get(joke_id), prediction)
+    return joke_id
 
 
 def rate_joke(request, joke_id, rating):
@@ -117,7 +140,7 @@ def rate_joke(request, joke_id, rating):
     :return: An HTTP response confirming that the rating was successfully processed.
     """
     user = get_user(request)
-    joke = Joke.objects.get(id=joke_id)
+    joke = joke_catalog().get(joke_id)
     rating = Rating.create(user, joke, float(rating))
 
     user.increment_rated_and_save()
@@ -132,36 +155,132 @@ def rate_joke(request, joke_id, rating):
     return HttpResponse('OK')
 
 
+def parse_ratings(body):
+    """
+    Parses a batch of ratings.
+
+    :param body: A JSON formatted list of [joke_id, rating] or
+        [joke_id, rating, rating_type] entries.
+    :return: A list of (joke id, rating, rating type) tuples. The rating type
+        is None when the entry does not specify it.
+    :raise ValueError: If the batch is malformed, or if a rating is not a
+        number between MIN_RATING and MAX_RATING.
+    """
+    ratings = []
+    for entry in json.loads(body):
+        if not isinstance(entry, list) or len(entry) not in (2, 3):
+            raise ValueError('Malformed entry')
+        joke_id, rating = int(entry[0]), float(entry[1])
+        # Also rejects NaN, which compares false to every number
+        if not MIN_RATING <= rating <= MAX_RATING:
+            raise ValueError('Rating out of range')
+        rating_type = int(entry[2]) if len(entry) == 3 else None
+        if rating_type is not None and rating_type not in RatingType.labels:
+            raise ValueError('Unknown rating type')
+        ratings.append((joke_id, rating, rating_type))
+    return ratings
+
+
+@csrf_exempt
+@require_POST
+def rate_jokes(request):
+    """
+    Accepts a batch of ratings from the user, such as the ratings queued by an
+    offline client, and stores them in a single transaction. The ratings are
+    inserted in bulk and the user information is only updated once.
+
+    The body of the request must be a JSON formatted list of [joke_id, rating]
+    pairs, in the order in which the jokes were rated. Each pair may be
+    followed by the rating type (see RatingType) of the joke when it was
+    displayed; ratings without one are given the type of the last joke
+    requested by the user. All the ratings of a batch are timestamped with
+    the time at which the batch is received.
+
+    :return: An HTTP response confirming that the ratings were successfully
+        processed, or a 400 response if the batch is malformed.
+    """
+    try:
+        batch = parse_ratings(request.body)
+    except (ValueError, TypeError):
+        return HttpResponseBadRequest('Expected a list of [joke_id, rating] '
+                                      'pairs, with ratings between {0} and '
+                                      '{1}'.format(MIN_RATING, MAX_RATING))
+    if len(batch) > MAX_BATCH_SIZE:
+        return HttpResponseBadRequest('At most {0} ratings can be submitted '
+                                      'at once'.format(MAX_BATCH_SIZE))
+    catalog = joke_catalog()
+    joke_ids = [joke_id for joke_id, _, _ in batch]
+    if any(joke_id not in catalog.jokes for joke_id in joke_ids):
+        return HttpResponseBadRequest('Unknown joke id')
+    if len(set(joke_ids)) != len(joke_ids):
+        return HttpResponseBadRequest('A joke can only be rated once per batch')
+
+    user = get_user(request)
+    # Users must rate the gauge set before any other joke
+    gauge_set = GAUGE_SET[min(user.jokes_rated, GAUGE_SET_SIZE):]
+    if joke_ids[:len(gauge_set)] != gauge_set[:len(joke_ids)]:
+        return HttpResponseBadRequest('The gauge set must be rated first')
+    with transaction.atomic():
+        ratings = [Rating.create(user, catalog.get(joke_id), rating, rating_type)
+                   for joke_id, rating, rating_type in batch]
+        Rating.objects.bulk_create(ratings)
+
+        # Users that have rated the gauge set already have a model
+        model = user.load_model() if user.jokes_rated >= GAUGE_SET_SIZE else None
+        # Resolve the recommender model once for the whole batch
+        stored_model = get_stored_model() if \
+            user.jokes_rated + len(batch) >= GAUGE_SET_SIZE else None
+        for rating in ratings:
+            user.jokes_rated += 1
+            if user.jokes_rated == GAUGE_SET_SIZE:
+                model = create_user_model(user, stored_model, catalog)
+            elif user.jokes_rated > GAUGE_SET_SIZE:
+                apply_rating(user, model, rating.joke, rating, stored_model,
+                             catalog)
+        if model is not None:
+            user.state = model.pack()
+        user.stale = True
+        user.save()
+
+    for rating in ratings:
+        log_rating(request, user, rating.joke, rating)
+    return HttpResponse('OK')
+
+
 def assign_to_cluster(user):
     """
-    Assigns a user to a cluster.
+    Assigns a user to a cluster and stores the new user model in the db.
 
-    :param user_id: The user_id of the user.
+    :param user: The user, who must have rated the gauge set.
     """
-    # Load the recommender model from MySQL db and load it into a python class.
-    recommender_model = RecommenderModel.objects.get()
-    stored_model = StoredEigentasteModel(recommender_model.data)
+    model = create_user_model(user, get_stored_model(), joke_catalog())
+    store_user_params(user, model)
+
 
-    # Load the user ratings, ordered by joke id
-    user_ratings = [rating.to_float() for rating
-                    in Rating.objects.filter(user=user).order_by('joke')]
+def create_user_model(user, stored_model, catalog):
+    """
+    Creates the model of a user that has rated the gauge set, by assigning
+    the user to a cluster.
+
+    :param user: The user, who must have rated the gauge set.
+    :param stored_model: The recommender model, see get_stored_model.
+    :param catalog: The joke catalog, see joke_catalog.
+    :return: The new user model, updated with the gauge set ratings.
+    """
+
+    # Load the user's gauge set ratings, ordered by joke id
+    user_ratings = [rating.to_float() for rating in Rating.objects.
+                    filter(user=user, joke__in=GAUGE_SET).order_by('joke')]
     # Project the user using the principal components calculated from the training set.
     user_ratings = stored_model.transform(user_ratings)
     cluster_id = stored_model.classify(user_ratings)
 
-    # Initialize the moving averages vectors
-    moving_averages = stored_model.moving_averages(cluster_id)
-    model = {
-        'user cluster id': int(cluster_id),
-        'moving averages': moving_averages,
-        'jokes rated': [0] * JOKE_CLUSTERS,
-        'rated ids': []
-    }
-    # Store the user model information in the db. Update the user model with
+    # Initialize the moving averages vectors, and update the user model with
     # the gauge set ratings.
-
-    store_user_params(user, model)
-    update_gauge_set_ratings(user)
+    moving_averages = stored_model.moving_averages(cluster_id)
+    model = RaterState.create(cluster_id, moving_averages)
+    update_gauge_set_ratings(user, model, stored_model, catalog)
+    return model
 
 
 def store_user_params(user, model):
@@ -181,24 +300,34 @@ def update_user_model(user, joke, rating):
 
     """
     model = user.load_model()
-    recommender_model = RecommenderModel.objects.get()
-    stored_model = StoredEigentasteModel(recommender_model.data)
+    apply_rating(user, model, joke, rating, get_stored_model(), joke_catalog())
+    user.store_model_and_save(model)
+
+
+def apply_rating(user, model, joke, rating, stored_model, catalog):
+    """
+    Updates a user model with the rating for a particular joke, without
+    saving it.
 
+    :param stored_model: The recommender model, see get_stored_model.
+    :param catalog: The joke catalog, see joke_catalog.
+    """
     if joke.id <= OLD_JOKES:
-        prediction = stored_model.get_prediction(user, joke)
+        prediction = stored_model.predict(model.user_cluster_id, joke.id)
         log_prediction(user, joke, prediction)
-        model['jokes rated'][joke.cluster_id()] += 1
-        model['moving averages'][joke.cluster_id()].pop(0)
-        model['moving averages'][joke.cluster_id()].append(rating.to_float())
+        cluster_id = catalog.cluster_id(joke.id)
+        # Jokes without a joke cluster have no moving average to update
+        if cluster_id is not None:
+            model.rate(cluster_id, rating.to_float())
 
-    model['rated ids'].append(joke.id)
-    user.store_model_and_save(model)
+    model.mark_rated(joke.id)
 
 
-def update_gauge_set_ratings(user):
-    for joke in GAUGE_SET_JOKES:
+def update_gauge_set_ratings(user, model, stored_model, catalog):
+    for joke_id in GAUGE_SET:
+        joke = catalog.get(joke_id)
         rating = Rating.objects.get(user=user, joke=joke)
-        update_user_model(user, joke, rating)
+        apply_rating(user, model, joke, rating, stored_model, catalog)
 
 
 def log_slider(request, old_rating, new_rating):
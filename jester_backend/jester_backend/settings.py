@@ -73,6 +73,23 @@ DATABASES = {
     }
 }
 
+# Directory in which recommender models are stored in the binary format
+RECOMMENDER_MODEL_DIR = os.path.join(BASE_DIR, 'models')
+
+# UserLog and RecommenderLog rows are buffered in memory and inserted in bulk
+# by a background thread once LOG_BUFFER_SIZE rows are queued or every
+# LOG_FLUSH_INTERVAL seconds
+LOG_BUFFER_SIZE = 200
+LOG_FLUSH_INTERVAL = 5
+
+# Fraction of users whose recommender decisions are logged in RecommenderLog
+RECOMMENDER_LOG_SAMPLE_RATE = 1.0
+
+# Number of seconds for which data_visualization responses are cached before
+# checking for new ratings. Explicit invalidation (e.g by scripts/rollup.py)
+# is stored in the db, so it reaches every process with any cache backend.
+DATA_VISUALIZATION_CACHE_TTL = 60
+
 EMAIL_HOST = 'localhost'
 EMAIL_HOST_PASSWORD = ''
 EMAIL_HOST_USER = ''
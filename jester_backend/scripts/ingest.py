@@ -0,0 +1,201 @@
+"""
+    Streaming bulk import of Jester rating files.
+
+    Rating files are csv files with one rating per line, in one of the
+    following formats:
+        user_id,joke_id,rating                  (Jester 4)
+        user_id,joke_id,joke_rating_idx,rating  (Jester 5)
+
+    The file is read once, in chunks. Each chunk is inserted with bulk_create
+    inside its own transaction, after creating the raters and jokes it refers
+    to. The number of jokes rated by each imported rater is computed with a
+    single query once all the ratings are imported. Parsing can optionally be
+    spread across several processes, which only read a few chunks ahead of
+    the inserts, so memory use does not depend on the size of the file.
+
+    Usage:
+        python ingest.py ../data/jester_4_ratings.csv --processes 4
+"""
+from __future__ import division
+import argparse
+import django
+import os
+import time
+from collections import deque
+from itertools import imap, islice
+from multiprocessing import Pool
+
+__author__ = 'Viraj Mahesh'
+
+# Setup code required before importing modules
+os.environ['DJANGO_SETTINGS_MODULE'] = 'jester_backend.settings'
+django.setup()
+
+from django.db import connection, transaction
+from jester.models import *
+from jester.joke_catalog import invalidate_joke_catalog
+
+# Number of ratings inserted per transaction
+CHUNK_SIZE = 20000
+
+# Maximum number of ids in a single IN clause
+MAX_IN_CLAUSE = 1000
+
+# Number of chunks parsed ahead of the inserts, per process
+READ_AHEAD = 2
+
+
+def read_chunks(ratings_file, chunk_size):
+    """
+    Splits a file into chunks of lines.
+
+    :param ratings_file: The file to read from.
+    :param chunk_size: The number of lines in a chunk.
+    :return: A generator of lists of lines.
+    """
+    while True:
+        lines = list(islice(ratings_file, chunk_size))
+        if not lines:
+            return
+        yield lines
+
+
+def parse_chunk(lines):
+    """
+    Parses a chunk of lines of a rating file. The joke rating index of the
+    Jester 5 format is not stored, and is therefore ignored.
+
+    :return: A list of (user_id, joke_id, rating) tuples, where the ratings
+        are in stored units (see to_fixed_point).
+    """
+    ratings = []
+    for line in lines:
+        fields = line.split(',')
+        if len(fields) < 3:
+            continue
+        ratings.append((int(fields[0]), int(fields[1]),
+                        to_fixed_point(float(fields[-1]))))
+    return ratings
+
+
+def parse_chunks(chunks, pool, window):
+    """
+    Parses chunks of lines in a pool of processes, keeping at most window
+    chunks in flight so that the file is not read faster than the parsed
+    chunks are consumed.
+
+    :param chunks: An iterator of lists of lines, see read_chunks.
+    :param pool: The pool of processes.
+    :param window: The maximum number of chunks read ahead.
+    :return: A generator of parsed chunks, in the order of the file.
+    """
+    pending = deque()
+    for chunk in chunks:
+        pending.append(pool.apply_async(parse_chunk, (chunk,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def create_missing(Model, ids):
+    """
+    Creates objects of type Model with the given ids, if they do not exist.
+
+    :param Model: The class of the objects, i.e Rater or Joke.
+    :param ids: A set of ids.
+    """
+    ids = sorted(ids)
+    existing = set()
+    for start in xrange(0, len(ids), MAX_IN_CLAUSE):
+        batch = ids[start:start + MAX_IN_CLAUSE]
+        existing.update(Model.objects.filter(id__in=batch).
+                        values_list('id', flat=True))
+    Model.objects.bulk_create([Model(id=id) for id in ids if id not in existing])
+
+
+def insert_chunk(ratings, user_offset):
+    """
+    Inserts a chunk of parsed ratings in a single transaction. Timestamps are
+    NULL, as this information is missing.
+    """
+    ratings = [(user_id + user_offset, joke_id, rating) for
+               user_id, joke_id, rating in ratings]
+    with transaction.atomic():
+        create_missing(Rater, set(user_id for user_id, _, _ in ratings))
+        create_missing(Joke, set(joke_id for _, joke_id, _ in ratings))
+        Rating.objects.bulk_create([Rating(user_id=user_id, joke_id=joke_id,
+                                           rating=rating, timestamp=None)
+                                    for user_id, joke_id, rating in ratings])
+
+
+def update_jokes_rated(min_id, max_id):
+    """
+    Sets the number of jokes rated by each rater in a range of ids to the
+    number of ratings stored for that rater, using a single query.
+
+    :param min_id: The smallest id of the raters to update.
+    :param max_id: The largest id of the raters to update.
+    """
+    query = ('UPDATE {rater} SET jokes_rated = (SELECT COUNT(*) FROM {rating} '
+             'WHERE {rating}.user_id = {rater}.id) '
+             'WHERE {rater}.id BETWEEN %s AND %s').format(
+        rater=Rater._meta.db_table, rating=Rating._meta.db_table)
+    with transaction.atomic():
+        connection.cursor().execute(query, [min_id, max_id])
+
+
+def ingest(path, user_offset=0, chunk_size=CHUNK_SIZE, processes=1):
+    """
+    Imports a rating file. Creates raters and jokes if necessary, and updates
+    the number of jokes rated by each imported rater.
+
+    :param path: The path of the rating file.
+    :param user_offset: A number added to every user id in the file.
+    :param chunk_size: The number of ratings inserted per transaction.
+    :param processes: The number of processes used to parse the file.
+    :return: The number of ratings imported.
+    """
+    start = time.time()
+    count = 0
+    # The smallest and largest user id of each chunk
+    bounds = []
+    pool = Pool(processes) if processes > 1 else None
+    try:
+        with open(path) as ratings_file:
+            chunks = read_chunks(ratings_file, chunk_size)
+            parsed = parse_chunks(chunks, pool, READ_AHEAD * processes) if \
+                pool else imap(parse_chunk, chunks)
+            for ratings in parsed:
+                insert_chunk(ratings, user_offset)
+                if ratings:
+                    user_ids = [user_id for user_id, _, _ in ratings]
+                    bounds.extend([min(user_ids), max(user_ids)])
+                count += len(ratings)
+                print 'Imported {0} ratings ({1:.0f} ratings/s)'. \
+                    format(count, count / (time.time() - start))
+    finally:
+        if pool:
+            pool.close()
+    if bounds:
+        update_jokes_rated(min(bounds) + user_offset, max(bounds) + user_offset)
+    # Jokes may have been created without triggering the save signals
+    invalidate_joke_catalog()
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Imports a Jester rating file.')
+    parser.add_argument('path', help='the csv file containing the ratings')
+    parser.add_argument('--user-offset', type=int, default=0,
+                        help='number added to every user id in the file')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help='number of ratings inserted per transaction')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='number of processes used to parse the file')
+    args = parser.parse_args()
+    ingest(args.path, args.user_offset, args.chunk_size, args.processes)
+
+
+if __name__ == '__main__':
+    main()
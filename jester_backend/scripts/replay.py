@@ -0,0 +1,79 @@
+"""
+    Offline evaluation of the recommendation policy.
+
+    Replays held-out users of a dense ratings matrix (see
+    utilities.export_ratings_as_matrix) through the gauge set, cluster
+    assignment and moving average recommendation loop, and reports the NMAE
+    of the predictions of the recommended jokes, the hit rate of the
+    recommendations and the compute time of each step. By default a model is
+    trained on the remaining users; a stored binary model can be replayed
+    instead, in which case the held-out users may be part of its training set.
+
+    Usage:
+        python replay.py ../data/dataset.npy --steps 50
+        python replay.py ../data/dataset.npy --model ../models/eigentaste-...
+"""
+from __future__ import division
+import argparse
+import django
+import numpy as np
+import os
+import time
+
+__author__ = 'Viraj Mahesh'
+
+# Setup code required before importing modules
+os.environ['DJANGO_SETTINGS_MODULE'] = 'jester_backend.settings'
+django.setup()
+
+from eigentaste import Eigentaste, StoredEigentasteModel
+from eigentaste.evaluation import split_users, replay
+from eigentaste.sparse_ratings import from_dense
+
+# Gauge set jokes, indexed from 0 (see utilities.GAUGE_SET)
+GAUGE_SET = [7, 53]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replays held-out users '
+                                                 'through the recommender.')
+    parser.add_argument('path', help='the .npy file containing the ratings')
+    parser.add_argument('--model', help='directory of a stored binary model '
+                                        'to replay, instead of training one')
+    parser.add_argument('--steps', type=int, default=50,
+                        help='number of jokes recommended to each user')
+    parser.add_argument('--users', type=int, default=None,
+                        help='maximum number of held-out users to replay')
+    parser.add_argument('--test-fraction', type=float, default=0.1,
+                        help='fraction of users held out for evaluation')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed used to choose the held-out users')
+    args = parser.parse_args()
+
+    ratings = np.load(args.path, mmap_mode='r')
+    train_rows, test_rows = split_users(len(ratings), args.test_fraction,
+                                        args.seed)
+    if args.model:
+        model = StoredEigentasteModel.load(args.model)
+    else:
+        start = time.time()
+        eigentaste = Eigentaste(from_dense(ratings, train_rows),
+                                np.array(GAUGE_SET))
+        model = StoredEigentasteModel.from_arrays(eigentaste.export_arrays())
+        print 'Trained on {0} users in {1:.1f}s'.format(len(train_rows),
+                                                        time.time() - start)
+    start = time.time()
+    results = replay(model, ratings, test_rows[:args.users], GAUGE_SET,
+                     args.steps)
+    print 'Replayed {0} users in {1:.1f}s'.format(results['users'],
+                                                  time.time() - start)
+    print 'Recommendations: {0} ({1} rated)'.format(results['recommendations'],
+                                                    results['rated'])
+    print 'NMAE: {0:.4f}'.format(results['nmae'])
+    print 'Hit rate: {0:.4f}'.format(results['hit rate'])
+    print 'Step time: {0:.2f}ms per batch, {1:.2f}us per user'.format(
+        results['batch step time'] * 1e3, results['user step time'] * 1e6)
+
+
+if __name__ == '__main__':
+    main()
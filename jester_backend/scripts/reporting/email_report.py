@@ -1,8 +1,7 @@
 from __future__ import division
-from datetime import timedelta
+from datetime import datetime, time as day_start, timedelta
 import django
 import numpy as np
-import operator
 import os
 
 __author__ = 'Viraj Mahesh'
@@ -12,8 +11,12 @@ os.environ['DJANGO_SETTINGS_MODULE'] = 'jester_backend.settings'
 django.setup()
 
 from jester.models import *
+from jester.rollups import compact_ratings, top_jokes, MIN_RATING, MAX_RATING
 from django.core.mail import send_mail
 
+# Number of ratings read per query
+CHUNK_SIZE = 100000
+
 MAX_TOP_RATED_JOKES = 10
 MAX_TOP_VARIANCE_JOKES = 10
 
@@ -35,8 +38,87 @@ def merge_dictionaries(*args):
     return result
 
 
-def populate(rating_matrix, rating):
-    rating_matrix[rating.user_id - 1][rating.joke_id - 1] = rating.to_float()
+class RatingStatistics(object):
+    """
+    Statistics of a stream of ratings, updated one chunk of ratings at a time
+    in constant memory: the number and sum of the ratings, and a histogram of
+    the ratings from which the median, minimum and maximum rating are read.
+    Ratings are stored in units of 1 / RATING_SCALE, so each possible rating
+    has its own bin in the histogram, and the median read from it is exact.
+    """
+    def __init__(self):
+        self.total = 0.0
+        bins = int((MAX_RATING - MIN_RATING) * RATING_SCALE) + 1
+        self.histogram = np.zeros(bins, dtype=np.int64)
+
+    def update(self, ratings):
+        """
+        Adds a chunk of ratings to the statistics.
+
+        :param ratings: An array with the value of each rating.
+        """
+        self.total += np.sum(ratings)
+        bins = np.rint((np.clip(ratings, MIN_RATING, MAX_RATING) - MIN_RATING) *
+                       RATING_SCALE).astype(np.intp)
+        self.histogram += np.bincount(bins, minlength=len(self.histogram))
+
+    def count(self):
+        return int(np.sum(self.histogram))
+
+    def mean(self):
+        return self.total / self.count() if self.count() else np.nan
+
+    def rating(self, idx):
+        """
+        :return: The rating of a bin of the histogram.
+        """
+        return idx / RATING_SCALE + MIN_RATING
+
+    def median(self):
+        count = self.count()
+        if count == 0:
+            return np.nan
+        cumulative = np.cumsum(self.histogram)
+        lower = np.searchsorted(cumulative, (count - 1) // 2, side='right')
+        upper = np.searchsorted(cumulative, count // 2, side='right')
+        return (self.rating(lower) + self.rating(upper)) / 2
+
+    def min(self):
+        rated = np.flatnonzero(self.histogram)
+        return self.rating(rated[0]) if len(rated) else np.nan
+
+    def max(self):
+        rated = np.flatnonzero(self.histogram)
+        return self.rating(rated[-1]) if len(rated) else np.nan
+
+
+def read_ratings(chunk_size=CHUNK_SIZE):
+    """
+    Reads all ratings in chunks, using one query per chunk.
+
+    :return: A generator of arrays of ratings.
+    """
+    last_id = 0
+    while True:
+        rows = list(Rating.objects.filter(id__gt=last_id).order_by('id').
+                    values_list('id', 'rating')[:chunk_size])
+        if not rows:
+            return
+        ids, ratings = zip(*rows)
+        yield np.array(ratings, dtype=np.int32) / RATING_SCALE
+        last_id = ids[-1]
+
+
+def read_ratings_in_range(start, end):
+    """
+    Reads the ratings made between two times, from the (timestamp, rating)
+    index of the rating table.
+
+    :return: An array of ratings.
+    """
+    ratings = Rating.objects.filter(timestamp__range=(start, end)). \
+        values_list('rating', flat=True)
+    return np.array(list(ratings), dtype=np.int32) / RATING_SCALE
 
 
 def main():
@@ -48,25 +130,25 @@ def main():
     today = timezone.now().date()
     yesterday = today + timedelta(days=-1)
 
-    daily_ratings = Rating.objects.filter(timestamp__range=[yesterday, today])
+    start = timezone.make_aware(datetime.combine(yesterday, day_start()),
+                                timezone.utc)
+    end = timezone.make_aware(datetime.combine(today, day_start()),
+                              timezone.utc)
 
     users = Rater.objects.count()
-    jokes = Joke.objects.count()
-    all_ratings = Rating.objects.count()
-
-    rating_matrix = np.zeros((users, jokes))
-    rating_matrix.fill(np.nan)
 
-    daily_rating_matrix = np.zeros((users, jokes))
-    daily_rating_matrix.fill(np.nan)
+    # Compute the statistics of all ratings in a single pass over the ratings,
+    # and those of the daily ratings from the ratings of the day only
+    rating_stats = RatingStatistics()
+    for ratings in read_ratings():
+        rating_stats.update(ratings)
+    daily_rating_stats = RatingStatistics()
+    daily_rating_stats.update(read_ratings_in_range(start, end))
 
-    for rating in Rating.objects.all():
-        populate(rating_matrix, rating)
+    # Bring the joke statistics up to date before ranking the jokes
+    compact_ratings()
 
-    for rating in daily_ratings:
-        populate(daily_rating_matrix, rating)
-
-    rating_count = np.array([user.jokes_rated for user in Rater.objects.all()])
+    rating_count = np.array(Rater.objects.values_list('jokes_rated', flat=True))
 
     header = {
         'time': time.strftime('%H:%M:%S'),
@@ -75,39 +157,39 @@ def main():
     }
 
     daily_stats = {
-        'daily_ratings_count': daily_ratings.count(),
-        'mean_daily_rating': np.nanmean(daily_rating_matrix),
-        'median_daily_rating': np.nanmedian(daily_rating_matrix),
+        'daily_ratings_count': daily_rating_stats.count(),
+        'mean_daily_rating': daily_rating_stats.mean(),
+        'median_daily_rating': daily_rating_stats.median(),
     }
 
     aggregate_stats = {
         'total_users': users,
-        'total_ratings': all_ratings,
-        'mean_rating': np.nanmean(rating_matrix),
-        'median_rating': np.nanmedian(rating_matrix),
-        'min_rating': np.nanmin(rating_matrix),
-        'max_rating': np.nanmax(rating_matrix),
+        'total_ratings': rating_stats.count(),
+        'mean_rating': rating_stats.mean(),
+        'median_rating': rating_stats.median(),
+        'min_rating': rating_stats.min(),
+        'max_rating': rating_stats.max(),
         'mean_number_of_jokes_rated': np.nanmean(rating_count),
         'median_number_of_jokes_rated': np.nanmedian(rating_count),
         'min_number_of_jokes_rated': np.nanmin(rating_count),
         'max_number_of_jokes_rated': np.nanmax(rating_count)
     }
 
-    mean_ratings = np.nanmean(rating_matrix, axis=0)
-    mean_ratings = [(id + 1, mean) for id, mean in enumerate(mean_ratings)]
-    mean_ratings.sort(key=operator.itemgetter(1), reverse=True)
-
-    variances = np.nanvar(rating_matrix, axis=0)
-    variances = [(id + 1, variance) for id, variance in enumerate(variances)]
-    variances.sort(key=operator.itemgetter(1), reverse=True)
+    mean_ratings = top_jokes('mean', MAX_TOP_RATED_JOKES)
+    variances = top_jokes('variance', MAX_TOP_VARIANCE_JOKES)
 
+    # The report has a line for each top joke, which is left empty when
+    # fewer jokes have been rated
     for i in xrange(MAX_TOP_RATED_JOKES):
-        id, mean = mean_ratings[i]
+        aggregate_stats['top_rated_joke_{0}'.format(i + 1)] = ''
+    for i in xrange(MAX_TOP_VARIANCE_JOKES):
+        aggregate_stats['top_variance_joke_{0}'.format(i + 1)] = ''
+
+    for i, (id, mean, _, _) in enumerate(mean_ratings):
         joke = 'top_rated_joke_{0}'.format(i + 1)
         aggregate_stats[joke] = TOP_RATED_JOKE_TMPL.format(id, mean)
 
-    for i in xrange(MAX_TOP_VARIANCE_JOKES):
-        id, variance = variances[i]
+    for i, (id, _, variance, _) in enumerate(variances):
         joke = 'top_variance_joke_{0}'.format(i + 1)
         aggregate_stats[joke] = TOP_VARIANCE_JOKE_TMPL.format(id, variance)
 
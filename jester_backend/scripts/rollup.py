@@ -0,0 +1,37 @@
+"""
+    Updates the analytics rollups (see jester.rollups) with the ratings and
+    user logs stored since the previous run. Meant to be run periodically
+    (e.g from cron).
+
+    Usage:
+        python rollup.py
+"""
+import django
+import os
+import time
+
+__author__ = 'Viraj Mahesh'
+
+# Setup code required before importing modules
+os.environ['DJANGO_SETTINGS_MODULE'] = 'jester_backend.settings'
+django.setup()
+
+from jester.rollups import compact_ratings, compact_user_logs
+from jester.data_visualization.caching import invalidate_data_visualization
+
+
+def main():
+    start = time.time()
+    count = compact_ratings()
+    if count:
+        invalidate_data_visualization()
+    print 'Added {0} ratings to the rollups in {1:.1f}s'.format(
+        count, time.time() - start)
+    start = time.time()
+    count = compact_user_logs()
+    print 'Added {0} user logs to the sessions in {1:.1f}s'.format(
+        count, time.time() - start)
+
+
+if __name__ == '__main__':
+    main()
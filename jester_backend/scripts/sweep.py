@@ -0,0 +1,118 @@
+"""
+    Parameter sweep for Eigentaste.
+
+    Trains one model for every combination of user clustering levels, number
+    of joke clusters and gauge set, using a pool of processes. Workers memory
+    map the dense ratings matrix (see utilities.export_ratings_as_matrix),
+    so it is shared by all the processes instead of being copied to each of
+    them. The same random set of users is held out from every model, and the
+    training time and held-out NMAE of each configuration are reported.
+
+    Usage:
+        python sweep.py ../data/dataset.npy --levels 2 3 4 5 \
+            --joke-clusters 10 15 20 --gauge-sets 7,53 7,53,12 --processes 4
+"""
+from __future__ import division
+import argparse
+import django
+import numpy as np
+import os
+import time
+from itertools import product
+from multiprocessing import Pool
+
+__author__ = 'Viraj Mahesh'
+
+# Setup code required before importing modules
+os.environ['DJANGO_SETTINGS_MODULE'] = 'jester_backend.settings'
+django.setup()
+
+from eigentaste import Eigentaste
+from eigentaste.evaluation import split_users, held_out_error
+from eigentaste.sparse_ratings import from_dense
+
+
+def train_and_evaluate(configuration):
+    """
+    Trains and evaluates a model for a single configuration.
+
+    :param configuration: A tuple (dataset path, levels, joke clusters, gauge
+        set, test fraction, seed).
+    :return: A dictionary containing the configuration and its results.
+    """
+    path, levels, joke_clusters, gauge, test_fraction, seed = configuration
+    ratings = np.load(path, mmap_mode='r')
+    train_rows, test_rows = split_users(len(ratings), test_fraction, seed)
+    start = time.time()
+    # Only the training ratings are copied out of the shared matrix
+    model = Eigentaste(from_dense(ratings, train_rows), np.array(gauge),
+                       levels, joke_clusters)
+    training_time = time.time() - start
+    error, count = held_out_error(model, ratings, test_rows)
+    return {'levels': levels, 'joke clusters': joke_clusters,
+            'gauge': gauge, 'user clusters': len(model.clusters),
+            'training time': training_time, 'nmae': error,
+            'ratings': count}
+
+
+def sweep(path, levels, joke_clusters, gauge_sets, test_fraction=0.1,
+          seed=0, processes=None):
+    """
+    Trains and evaluates a model for every combination of parameters.
+
+    :param path: The path of a dense ratings matrix saved with np.save.
+    :param levels: A list of user clustering levels.
+    :param joke_clusters: A list of numbers of joke clusters.
+    :param gauge_sets: A list of gauge sets, each a list of joke indices.
+    :param test_fraction: The fraction of users held out for evaluation.
+    :param seed: The seed used to choose the held-out users.
+    :param processes: The number of processes, by default the number of CPUs.
+    :return: A list of results, see train_and_evaluate, ordered by NMAE.
+        Configurations without held-out ratings have a NaN NMAE, and are
+        listed last.
+    """
+    configurations = [(path, level, k, gauge, test_fraction, seed) for
+                      level, k, gauge in product(levels, joke_clusters,
+                                                 gauge_sets)]
+    pool = Pool(processes)
+    try:
+        results = pool.map(train_and_evaluate, configurations, chunksize=1)
+    finally:
+        pool.close()
+    # NaN compares false to every value, which would break the order
+    return sorted(results, key=lambda result: (np.isnan(result['nmae']),
+                                               result['nmae']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sweeps Eigentaste parameters.')
+    parser.add_argument('path', help='the .npy file containing the ratings')
+    parser.add_argument('--levels', type=int, nargs='+', default=[4],
+                        help='numbers of user clustering levels')
+    parser.add_argument('--joke-clusters', type=int, nargs='+', default=[15],
+                        help='numbers of joke clusters')
+    parser.add_argument('--gauge-sets', nargs='+', default=['7,53'],
+                        help='comma separated joke indices, indexed from 0')
+    parser.add_argument('--test-fraction', type=float, default=0.1,
+                        help='fraction of users held out for evaluation')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed used to choose the held-out users')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of processes, by default the number of CPUs')
+    args = parser.parse_args()
+    gauge_sets = [[int(idx) for idx in gauge.split(',')] for gauge
+                  in args.gauge_sets]
+    results = sweep(args.path, args.levels, args.joke_clusters, gauge_sets,
+                    args.test_fraction, args.seed, args.processes)
+    print '{0:>6} {1:>6} {2:>14} {3:>8} {4:>9} {5:>8} {6:>9}'.format(
+        'levels', 'jokes', 'gauge', 'clusters', 'time (s)', 'nmae', 'ratings')
+    for result in results:
+        print '{0:>6} {1:>6} {2:>14} {3:>8} {4:>9.2f} {5:>8.4f} {6:>9}'.format(
+            result['levels'], result['joke clusters'],
+            ','.join(str(idx) for idx in result['gauge']),
+            result['user clusters'], result['training time'], result['nmae'],
+            result['ratings'])
+
+
+if __name__ == '__main__':
+    main()
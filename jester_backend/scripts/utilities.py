@@ -11,10 +11,14 @@
         ALTER TABLE <table name> AUTO_INCREMENT = 1;\
 """
 from __future__ import division
+import json
 import re
 import django
 import numpy as np
 import os
+import time
+from datetime import datetime
+from scipy.sparse import csr_matrix
 
 __author__ = 'Viraj Mahesh'
 
@@ -22,8 +26,17 @@ __author__ = 'Viraj Mahesh'
 os.environ['DJANGO_SETTINGS_MODULE'] = 'jester_backend.settings'
 django.setup()
 
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max, Q
 from jester.models import *
+from jester.joke_catalog import invalidate_joke_catalog
+from jester.rollups import find_gaps, fill_gaps, read_gaps, MAX_RANGES
+from jester.rater_state import RaterState
 from eigentaste import Eigentaste
+from eigentaste.eigentaste import refresh_arrays
+from eigentaste.storage import load_arrays, save_arrays
+from ingest import ingest, MAX_IN_CLAUSE
 
 IMPORTED_JOKES = False
 IMPORTED_NEW_JOKES = False
@@ -80,6 +93,7 @@ def import_jokes(clear_db=False, removed={}):
         joke.save()
     # Close the file
     joke_file.close()
+    invalidate_joke_catalog()
 
 
 def get(Model, **kwargs):
@@ -98,65 +112,28 @@ def get(Model, **kwargs):
     return objects
 
 
-def count_lines(file):
-    """
-    Counts the number of lines in a file by reading it line by line. Resets
-    the file pointer to the beginning of the file
-
-    :param file: The file to read from.
-    :return: Then number of lines in the file.
-    """
-    line_count = 0
-    for _ in file:
-        line_count += 1
-    file.seek(0)
-    return line_count
-
-
 def import_old_ratings():
     """
     Imports ratings from the jester 4 file which is in csv format. Creates new
     users in the jester_user table if necessary. Also updates the rating_count
-    for each user.
+    for each user. See ingest.ingest for details.
 
     Assumes that no other ratings exist in the jester_rating table.
 
-    Timestamps are NULL, as this information is missing. Joke_idxs are 0, as
-    this information is missing.
+    Timestamps are NULL, as this information is missing.
 
     :return: None
     """
     if IMPORTED_OLD_RATINGS:
         return
-    jester_4_ratings = file('../data/jester_4_ratings.csv')
-    # Counting the number of lines in the file for progress report
-    line_count = count_lines(jester_4_ratings)
-    print 'Counted {0} lines'.format(line_count)
-    # Read each rating line by line
-    for idx, rating in enumerate(jester_4_ratings):
-        # Progress Report every 1%
-        if idx % (line_count // 100) == 0:
-            print 'Completed {0}% of data import'.format(idx / line_count * 100)
-        # Split the rating into individual components and parse
-        user_id, joke_id, rating = rating.split(',')
-        user_id, joke_id, rating = int(user_id), int(joke_id), float(rating)
-        # Get or create objects corresponding to the parameters
-        user = get(Rater, id=user_id)[0]
-        joke = get(Joke, id=joke_id)[0]
-        # Create a new rating to insert into the db. Note that timestamp
-        # and joke idx (i.e order of joke presentation) is missing in this dataset
-        rating = Rating(user=user, joke=joke, joke_rating_idx=0, rating=rating, timestamp=None)
-        user.increment_rated_and_save()
-        rating.save()  # Save the newly read rating into the db
-    # Close the file
-    jester_4_ratings.close()
+    ingest('../data/jester_4_ratings.csv')
 
 
 def import_new_ratings():
     """
     Imports ratings from the jester 5 file which is is csv format. Creates new
     users in the jester_table if necessary. Also updates the rating_count
-    for each user.
+    for each user. See ingest.ingest for details.
 
     Assumes that no other ratings exist in the jester_rating table.
 
@@ -168,80 +145,317 @@ def import_new_ratings():
         return
     offset = Rater.objects.count()
     print '{0} ratings already in db'.format(offset)
-    jester_5_ratings = file('../data/jester_5_ratings.csv')
-    # Counting the number of lines in the file for progress report
-    line_count = count_lines(jester_5_ratings)
-    print 'Counted {0} lines'.format(line_count)
-    for idx, rating in enumerate(jester_5_ratings):
-        # Progress Report every 1%
-        if idx % (line_count // 100) == 0:
-            print 'Completed {0}% of data import'.format(idx / line_count * 100)
-        # Split the rating into individual components and parse
-        user_id, joke_id, joke_rating_idx, rating = rating.split(',')
-        user_id, joke_id, joke_rating_idx, rating = int(user_id), int(joke_id), \
-                                                    int(joke_rating_idx), float(rating)
-        user = get(User, id=user_id + offset)[0]
-        joke = get(Joke, id=joke_id)[0]
-        rating = Rating(user=user, joke=joke, joke_rating_idx=joke_rating_idx,
-                        rating=rating, timestamp=None)
-        user.increment_rated_and_save()
-        rating.save()
-    # Close the file
-    jester_5_ratings.close()
+    ingest('../data/jester_5_ratings.csv', user_offset=offset)
+
 
+def sparse_matrix_path(path):
+    """
+    :return: The path with its extension replaced by .npz, which np.savez
+        would otherwise append to the path (e.g ratings.npy.npz).
+    """
+    return os.path.splitext(path)[0] + '.npz'
+
+
+def save_sparse_matrix(save_file, matrix):
+    """
+    Saves a sparse matrix in CSR format, using the same .npz layout as
+    scipy.sparse.save_npz (which is not available in older versions of scipy).
+
+    :param save_file: The path of the file, whose extension is replaced by
+        .npz, see sparse_matrix_path.
+    :return: The path of the saved file.
+    """
+    save_file = sparse_matrix_path(save_file)
+    matrix = matrix.tocsr()
+    np.savez(save_file, format=np.array('csr'), shape=np.array(matrix.shape),
+             data=matrix.data, indices=matrix.indices, indptr=matrix.indptr)
+    return save_file
+
+
+def load_sparse_matrix(load_file):
+    """
+    Loads a sparse matrix saved by save_sparse_matrix, under the same path.
+    """
+    arrays = np.load(sparse_matrix_path(load_file))
+    return csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']),
+                      shape=tuple(arrays['shape']))
+
+
+def dataset_info_path(path):
+    """
+    :return: The path of the file describing the ratings in a dataset.
+    """
+    return os.path.splitext(path)[0] + '.json'
+
+
+def save_dataset_info(path, last_rating_id, rating_gaps):
+    """
+    Records which ratings were exported to a dataset, so that the model
+    trained on it only folds the other ratings, see build_model.
 
-def export_ratings_as_matrix(save_file='../data/old_ratings.npy'):
+    :param path: The path of the dataset.
+    :param last_rating_id: The id of the last exported rating.
+    :param rating_gaps: The ranges of ids below last_rating_id that were
+        missing when the ratings were exported, see find_gaps.
     """
-    Exports all the old ratings as a matrix
+    info = open(dataset_info_path(path), 'w')
+    json.dump({'last rating id': last_rating_id, 'rating gaps': rating_gaps},
+              info)
+    info.close()
+
+
+def load_dataset_info(path):
+    """
+    :return: A tuple (id of the last exported rating, rating gaps) of a
+        dataset, see save_dataset_info.
+    :raise IOError: If the dataset was not exported by export_ratings_as_matrix.
+    """
+    info = open(dataset_info_path(path))
+    fields = json.load(info)
+    info.close()
+    return fields['last rating id'], fields['rating gaps']
+
+
+def export_ratings_as_matrix(save_file='../data/old_ratings.npy', sparse=False):
+    """
+    Exports all the old ratings as a matrix. Rows correspond to users that
+    have at least one rating, in order of id, and column j corresponds to the
+    joke with id j + 1. If a user rated a joke more than once, the latest
+    rating is kept.
+
+    :param save_file: The file in which the matrix is saved. The id of the
+        last exported rating is saved next to it, see save_dataset_info.
+    :param sparse: If True, the matrix is saved as a scipy.sparse CSR matrix
+        in .npz format (see save_sparse_matrix), in which missing ratings are
+        not stored. The extension of save_file is then replaced by .npz, e.g
+        the default file becomes ../data/old_ratings.npz. Otherwise the matrix is saved as a dense .npy array in
+        which missing ratings are NaN.
     :return: None
     """
     if EXPORTED_RATINGS:
         return
-    # Get total number of jokes and users
-    jokes = Joke.objects.count()
-    users = User.objects.latest('id').id
-    # Create an empty matrix of size U x J, where U is the number of users and
-    # J is the number of jokes
-    rating_matrix = np.empty((users, jokes))
-    rating_matrix[:] = np.nan
-    # Get users that have rated each joke and update rating matrix
-    for id in xrange(1, jokes + 1):
-        print 'Completed {0}% of matrix construction'.format(id / jokes * 100)
-        joke = get(Joke, id=id)[0]
-        for rating in Rating.objects.filter(joke=joke):
-            rating_matrix[rating.user.id - 1][id - 1] = rating.rating
-    # Remove the rows that have no ratings
-    rows_to_delete = []
-    for idx, row in enumerate(np.copy(rating_matrix)):
-        if np.count_nonzero(~np.isnan(row)) == 0:
-            rows_to_delete.append(idx)
-    print 'Before deletion, dim(Ratings Matrix) = {0} x {1}'. \
-        format(*rating_matrix.shape)
-    rating_matrix = np.delete(rating_matrix, rows_to_delete, axis=0)
-    print 'After deletion, dim(Ratings Matrix) = {0} x {1}'. \
-        format(*rating_matrix.shape)
+    start = time.time()
+    # Read all ratings in a single pass, ordered so that later ratings
+    # overwrite earlier ones, and their ids from the same snapshot of the
+    # table
+    with transaction.atomic():
+        last_rating_id = latest_rating_id()
+        exported = Rating.objects.filter(id__lte=last_rating_id).order_by('id')
+        users, jokes, ratings = exported.as_arrays()
+        ids = np.array(exported.values_list('id', flat=True), dtype=np.int64)
+    print 'Read {0} ratings'.format(len(ratings))
+    # Users without ratings get no row
+    user_ids, rows = np.unique(users, return_inverse=True)
+    columns = jokes - 1
+    shape = (len(user_ids), Joke.objects.latest('id').id)
+    # Keep the latest rating of each (user, joke) pair
+    cells = rows * shape[1] + columns
+    _, latest = np.unique(cells[::-1], return_index=True)
+    latest = len(cells) - 1 - latest
+    rows, columns, ratings = rows[latest], columns[latest], ratings[latest]
+    print 'dim(Ratings Matrix) = {0} x {1}'.format(*shape)
     # Save the ratings matrix to file
-    np.save(save_file, rating_matrix)
-
-
-def build_model():
+    if sparse:
+        save_file = save_sparse_matrix(
+            save_file, csr_matrix((ratings, (rows, columns)), shape=shape))
+    else:
+        rating_matrix = np.empty(shape)
+        rating_matrix.fill(np.nan)
+        rating_matrix[rows, columns] = ratings
+        np.save(save_file, rating_matrix)
+    # Ratings stored after the export are folded into the model trained on
+    # it by refresh_model
+    save_dataset_info(save_file, last_rating_id, find_gaps(ids, 0, start))
+    print 'Saved the ratings matrix to {0}'.format(save_file)
+
+
+def build_model(dataset='../data/dataset.npy', last_rating_id=None):
+    """
+    Trains Eigentaste and stores the resulting model.
+
+    :param dataset: The ratings matrix to train on, either a dense .npy
+        matrix or a sparse .npz matrix, see export_ratings_as_matrix.
+    :param last_rating_id: The id of the last rating in the dataset. Ratings
+        with a larger id are folded into the model by refresh_model. By
+        default it is the id recorded when the dataset was exported, which
+        must be given for datasets that were not exported from the db.
+    """
     if BUILT_MODELS:
         return
-    data = np.load('../data/dataset.npy')
+    if dataset.endswith('.npz'):
+        data = load_sparse_matrix(dataset)
+    else:
+        data = np.load(dataset)
+    if last_rating_id is None:
+        last_rating_id, rating_gaps = load_dataset_info(dataset)
+    else:
+        rating_gaps = []
     model = Eigentaste(data, GAUGE_SET)
     assign_joke_cluster_indices(model)
-    # Create a new RecommenderModel and then store the model in it
-    recommender_model = RecommenderModel()
-    recommender_model.store(model)
+    # Create a new RecommenderModel and then store the model in it, using the
+    # binary format so that it can be memory mapped by the web servers
+    recommender_model = RecommenderModel(last_rating_id=last_rating_id,
+                                         rating_gaps=json.dumps(rating_gaps))
+    recommender_model.store(model, model_path())
     # Save the model in the database
     recommender_model.save()
 
 
+def refresh_model():
+    """
+    Folds the ratings stored since the latest model was built into its
+    predictions, and publishes the result as a new model version. Only the
+    predictions, the joke cluster averages and the ranked jokes are updated;
+    PCA, the user clusters and the joke clusters are only refit by
+    build_model. Each rating is counted in the user cluster its rater was
+    assigned to.
+
+    Ratings that were committed after ratings with larger ids had been
+    folded are folded by a later refresh, see RecommenderModel.rating_gaps.
+    So are the ratings of raters that have not been assigned to a cluster
+    yet, such as raters midway through the gauge set or imported raters,
+    see RecommenderModel.pending_raters.
+
+    :return: The number of ratings folded into the model.
+    """
+    latest = RecommenderModel.objects.latest('id')
+    if not latest.path or latest.last_rating_id is None:
+        raise ValueError('The latest model must be rebuilt with build_model')
+    start = time.time()
+    gaps = json.loads(latest.rating_gaps)
+    pending = dict(json.loads(latest.pending_raters))
+    # Read the ratings and their ids from the same snapshot of the table
+    with transaction.atomic():
+        last_rating_id = latest_rating_id()
+        new_ratings = Rating.objects.filter(id__gt=latest.last_rating_id,
+                                            id__lte=last_rating_id).order_by('id')
+        users, jokes, ratings = new_ratings.as_arrays()
+        ids = np.array(new_ratings.values_list('id', flat=True), dtype=np.int64)
+        late = read_gaps(Rating.objects, gaps, ('user_id', 'joke_id', 'rating'))
+    if late:
+        late_ids, late_users, late_jokes, late_ratings = \
+            [np.array(column) for column in zip(*late)]
+        users = np.concatenate([late_users, users])
+        jokes = np.concatenate([late_jokes, jokes])
+        ratings = np.concatenate([late_ratings / RATING_SCALE, ratings])
+    else:
+        late_ids = np.empty(0, dtype=np.int64)
+    rating_ids = np.concatenate([late_ids, ids])
+    new_gaps = fill_gaps(gaps, late_ids, start) + \
+        find_gaps(ids, latest.last_rating_id, start)
+
+    # Look up the clusters of the raters of the new ratings and of the
+    # pending raters at once, so that all the ratings of a rater agree on
+    # whether it has been assigned to a cluster
+    pending_ids = np.array(sorted(pending), dtype=np.int64)
+    cluster_ids = rater_cluster_ids(np.concatenate([users, pending_ids]))
+    user_cluster_ids = cluster_ids[:len(users)]
+    pending_cluster_ids = cluster_ids[len(users):]
+    # Read the earlier ratings of the pending raters that have been assigned
+    # to a cluster since the last refresh
+    assigned = pending_ids[pending_cluster_ids >= 0].tolist()
+    earlier_users, earlier_jokes, earlier_ratings = read_pending_ratings(
+        [(rater_id, pending.pop(rater_id)) for rater_id in assigned],
+        latest.last_rating_id, gaps)
+    # The ratings of raters that have not been assigned to a cluster yet are
+    # left out, and folded by a later refresh
+    unclustered = user_cluster_ids < 0
+    for rater_id, rating_id in zip(users[unclustered].tolist(),
+                                   rating_ids[unclustered].tolist()):
+        pending[rater_id] = min(pending.get(rater_id, rating_id), rating_id)
+
+    users = np.concatenate([earlier_users, users])
+    jokes = np.concatenate([earlier_jokes, jokes])
+    ratings = np.concatenate([earlier_ratings, ratings])
+    user_cluster_ids = np.concatenate([
+        pending_cluster_ids[np.searchsorted(pending_ids, earlier_users)],
+        user_cluster_ids])
+    clustered = user_cluster_ids >= 0
+    arrays = refresh_arrays(load_arrays(latest.path), user_cluster_ids[clustered],
+                            jokes[clustered], ratings[clustered])
+    path = model_path()
+    save_arrays(arrays, path)
+    RecommenderModel.objects.create(
+        path=path, last_rating_id=last_rating_id,
+        rating_gaps=json.dumps(new_gaps),
+        pending_raters=json.dumps(sorted(pending.items())))
+    print 'Folded {0} ratings into the model in {1:.1f}s'. \
+        format(int(np.sum(clustered)), time.time() - start)
+    return int(np.sum(clustered))
+
+
+def read_pending_ratings(raters, last_rating_id, gaps):
+    """
+    Reads the ratings of pending raters that have not been folded into the
+    model, see RecommenderModel.pending_raters.
+
+    :param raters: A list of (rater id, id of the first rating) pairs.
+    :param last_rating_id: The id of the last rating folded into the model.
+    :param gaps: The ranges of ids that were missing below last_rating_id,
+        whose ratings are read by read_gaps instead.
+    :return: A tuple of arrays (user ids, joke ids, ratings).
+    """
+    missing = Q()
+    for first, last, _ in gaps:
+        missing |= Q(id__range=(first, last))
+    rows = []
+    for start in xrange(0, len(raters), MAX_RANGES):
+        selected = Q()
+        for rater_id, first_id in raters[start:start + MAX_RANGES]:
+            selected |= Q(user=rater_id, id__gte=first_id)
+        queryset = Rating.objects.filter(selected, id__lte=last_rating_id)
+        if gaps:
+            queryset = queryset.exclude(missing)
+        rows.extend(queryset.values_list('user_id', 'joke_id', 'rating'))
+    if not rows:
+        return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64),
+                np.empty(0, dtype=np.float64))
+    users, jokes, ratings = [np.array(column) for column in zip(*rows)]
+    return users, jokes, ratings / RATING_SCALE
+
+
+def latest_rating_id():
+    """
+    :return: The id of the most recent rating, or 0 if there are no ratings.
+    """
+    return Rating.objects.aggregate(Max('id'))['id__max'] or 0
+
+
+def rater_cluster_ids(users):
+    """
+    Looks up the user cluster of the raters of a set of ratings.
+
+    :param users: An array of rater ids.
+    :return: An array with the user cluster id of each rater, which is -1
+        for raters that have not been assigned to a cluster.
+    """
+    rater_ids = np.unique(users)
+    cluster_ids = np.empty(len(rater_ids), dtype=np.int64)
+    cluster_ids.fill(-1)
+    for start in xrange(0, len(rater_ids), MAX_IN_CLAUSE):
+        batch = rater_ids[start:start + MAX_IN_CLAUSE].tolist()
+        states = Rater.objects.filter(id__in=batch, state__isnull=False). \
+            values_list('id', 'state')
+        for rater_id, state in states:
+            cluster_ids[np.searchsorted(rater_ids, rater_id)] = \
+                RaterState(state).user_cluster_id
+    return cluster_ids[np.searchsorted(rater_ids, users)]
+
+
+def model_path():
+    """
+    :return: A new directory in which a binary model can be stored.
+    """
+    name = datetime.now().strftime('eigentaste-%Y%m%d-%H%M%S-%f')
+    return os.path.join(settings.RECOMMENDER_MODEL_DIR, name)
+
+
 def assign_joke_cluster_indices(model):
     for idx, item_cluster in enumerate(model.joke_clusters):
         for joke_idx in item_cluster.indices:
             joke = get(Joke, id=joke_idx + 1)[0]
             joke.store_model_and_save({'cluster id': idx})
+    invalidate_joke_catalog()
 
 
 def import_new_jokes():
@@ -280,6 +494,7 @@ def import_new_jokes():
         joke.save()
     # Close the file
     joke_file.close()
+    invalidate_joke_catalog()
 
 
 def main():
@@ -11,6 +11,7 @@ __author__ = 'Viraj Mahesh'
 os.environ['DJANGO_SETTINGS_MODULE'] = 'jester_backend.settings'
 django.setup()
 
+from django.db.models import Count, Max, Min, Sum
 from jester.models import *
 
 
@@ -40,17 +41,21 @@ def display_user_stats(users):
 
 
 def display_time_stats():
-    users = Rater.objects.count()
-    times = []
-    for user in Rater.objects.all():
-        try:
-            user_queryset = UserLog.objects.filter(user=user)
-            first = user_queryset.earliest('timestamp').timestamp
-            last = user_queryset.latest('timestamp').timestamp
-            difference = (last - first).total_seconds() / 60.0
-            times.append(difference)
-        except UserLog.DoesNotExist:
-            print 'User does not exist'
+    """
+    Displays engagement statistics computed from the rater sessions, which
+    are built by scripts/rollup.py.
+    """
+    raters = (RaterSession.objects.values('user').
+              annotate(first=Min('start'), last=Max('end'),
+                       sessions=Count('id'), ratings=Sum('ratings')))
+    times, sessions, session_ratings = [], [], []
+    for rater in raters:
+        difference = (rater['last'] - rater['first']).total_seconds() / 60.0
+        times.append(difference)
+        sessions.append(rater['sessions'])
+        session_ratings.append(rater['ratings'] / rater['sessions'])
+    print 'Mean # of sessions per user: {0}'.format(np.mean(sessions))
+    print 'Mean # of ratings per session: {0}'.format(np.mean(session_ratings))
     times = filter(lambda x: operator.lt(x, 10), times)
     print 'Users that interacted with the system for less than 10 minutes: {0}'.format(len(times))
     print 'Mean time b/w first and last interaction: {0}'.format(np.mean(times))
@@ -98,7 +103,7 @@ def display_ratings_histogram(ratings):
 
 
 def main():
-    ratings = [rating.to_float() for rating in Rating.objects.all()]
+    _, _, ratings = Rating.objects.as_arrays()
     users = [user for user in Rater.objects.all()]
 
     display_user_stats(users)